@@ -1,10 +1,407 @@
+import os
+import sys
 import json
+import time
+import logging
+import argparse
+from itertools import islice
+from collections import deque
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'v2'))
+
+import snapshot
+from posts import poststore
+from index import snapshotindex
+from checkpoint import crawlcheckpoint
+from textindex import textindex
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Typed columns of the posts dataset, as named by the 4chan API; thread, captured and deleted are added
+# by the export, and board and day are the partition directories
+POST_COLUMNS = [
+    ('no', 'int64'), ('resto', 'int64'), ('thread', 'int64'), ('time', 'timestamp[s]'), ('now', 'string'),
+    ('name', 'string'), ('trip', 'string'), ('id', 'string'), ('capcode', 'string'), ('country', 'string'),
+    ('country_name', 'string'), ('board_flag', 'string'), ('flag_name', 'string'), ('sub', 'string'), ('com', 'string'),
+    ('tim', 'int64'), ('filename', 'string'), ('ext', 'string'), ('fsize', 'int64'), ('md5', 'string'),
+    ('w', 'int32'), ('h', 'int32'), ('tn_w', 'int32'), ('tn_h', 'int32'), ('filedeleted', 'int8'), ('spoiler', 'int8'),
+    ('custom_spoiler', 'int16'), ('sticky', 'int8'), ('closed', 'int8'), ('archived', 'int8'), ('archived_on', 'timestamp[s]'),
+    ('replies', 'int32'), ('images', 'int32'), ('unique_ips', 'int32'), ('bumplimit', 'int8'), ('imagelimit', 'int8'),
+    ('semantic_url', 'string'), ('tag', 'string'), ('since4pass', 'int16'), ('m_img', 'int8'),
+    ('captured', 'timestamp[ms]'), ('deleted', 'bool'),
+]
+# One row per capture of a thread
+THREAD_COLUMNS = [
+    ('thread', 'int64'), ('captured', 'timestamp[ms]'), ('posts', 'int32'), ('replies', 'int32'), ('images', 'int32'),
+    ('unique_ips', 'int32'), ('last_no', 'int64'), ('last_post', 'timestamp[s]'), ('sticky', 'int8'), ('closed', 'int8'),
+    ('archived', 'int8'), ('sub', 'string'), ('semantic_url', 'string'),
+]
+EXPORT_MANIFEST = '_manifest.json'
+EXPORT_VERSION = 2
+EXPORT_DATASETS = ('posts', 'threads')
+
+logger = logging.getLogger('4chan_parser')
+
+
+def _replay_deltas(path):
+    # One state per capture time, as the live deltastore would have seen it
+    posts = {}
+    states = []
+    current = None
+    for record in snapshot.iter_lines(path):
+        if current is not None and record['captured'] != current:
+            states.append((current, [dict(post) for post in posts.values()]))
+        current = record['captured']
+        if record['op'] == 'post':
+            posts[record['post']['no']] = record['post']
+        elif record['op'] == 'patch':
+            post = posts.setdefault(record['no'], {'no': record['no']})
+            post.update(record['set'])
+            for key in record['unset']:
+                post.pop(key, None)
+        elif record['op'] == 'delete':
+            posts.pop(record['no'], None)
+    if current is not None:
+        states.append((current, list(posts.values())))
+    return [(captured, sorted(state, key=lambda post: post['no'])) for captured, state in states]
+
+
+def decode(path):
+    # Runs in the worker processes, so only the reduced result is sent back. A save that cannot be
+    # read comes back as an error record instead of ending the whole run
+    try:
+        return _decode(Path(path))
+    except ImportError:
+        raise
+    except Exception as error:
+        return 'error', None, None, [(None, {'path': str(path), 'error': f'{type(error).__name__}: {error}'})]
+
+
+def _decode(path):
+    captured = path.stat().st_mtime
+    if path.parent.parent.name == 'threads':
+        board = path.parent.name
+        op_id = int(path.name.split('_')[0])
+        if snapshot.is_lines(path):
+            return 'thread', board, op_id, _replay_deltas(path)
+        return 'thread', board, op_id, [(captured, snapshot.load(path)['posts'])]
+    if path.parent.name == 'threads_on_boards':
+        board = path.name.split('_')[0]
+        listed = {thread['no']: [int(thread['last_modified']), int(thread['replies'])] for page in snapshot.load(path) for thread in page['threads']}
+        return 'threadlist', board, None, [(captured, listed)]
+    return 'boards', None, None, [(captured, snapshot.load(path))]
+
+
+def _schema(columns):
+    return pyarrow.schema([(name, pyarrow.type_for_alias(alias)) for name, alias in columns])
+
+
+def _utc_day(seconds):
+    return time.strftime('%Y_%m_%d', time.gmtime(seconds))
+
+
+def export_tables(paths):
+    # Runs in the worker processes: every save of one thread, oldest first, merged into the latest
+    # version of each post and one row per capture. Posts are split by the day they were posted and
+    # captures by the day they were taken, so a thread saved on several days is still exported once
+    board = Path(paths[0]).parent.name
+    op_id = int(Path(paths[0]).name.split('_')[0])
+    captures = []
+    errors = []
+    for path in paths:
+        record = decode(path)
+        if record[0] == 'error':
+            errors.append(record)
+        else:
+            captures.extend(record[3])
+    latest = {}
+    captured_at = {}
+    thread_rows = {}
+    for captured, posts in captures:
+        captured_ms = int(captured * 1000)
+        for post in posts:
+            latest[post['no']] = post
+            captured_at[post['no']] = captured_ms
+        op = posts[0] if posts else {}
+        thread_rows.setdefault(_utc_day(captured), []).append({
+            'thread': op_id, 'captured': captured_ms, 'posts': len(posts), 'replies': op.get('replies'), 'images': op.get('images'),
+            'unique_ips': op.get('unique_ips'), 'last_no': max((post['no'] for post in posts), default=None),
+            'last_post': max((post.get('time', 0) for post in posts), default=None), 'sticky': op.get('sticky'), 'closed': op.get('closed'),
+            'archived': op.get('archived'), 'sub': op.get('sub'), 'semantic_url': op.get('semantic_url'),
+        })
+    final = {post['no'] for post in captures[-1][1]} if captures else set()
+    post_rows = {}
+    for no, post in sorted(latest.items()):
+        day = _utc_day(post.get('time', captured_at[no] / 1000))
+        post_rows.setdefault(day, []).append(dict(post, thread=op_id, captured=captured_at[no], deleted=no not in final))
+    posts = {day: pyarrow.Table.from_pylist(rows, _schema(POST_COLUMNS)) for day, rows in post_rows.items()}
+    threads = {day: pyarrow.Table.from_pylist(rows, _schema(THREAD_COLUMNS)) for day, rows in thread_rows.items()}
+    return board, op_id, posts, threads, errors
+
+
+def _strip_part(path, threads):
+    # Drops the rows of re-exported threads from an older part, removing the part once it is empty
+    if not path.exists():
+        return
+    table = pyarrow.parquet.read_table(path)
+    keep = pyarrow.compute.invert(pyarrow.compute.is_in(table['thread'], value_set=pyarrow.array(threads, pyarrow.int64())))
+    table = table.filter(keep)
+    if table.num_rows:
+        tmppath = path.with_name(path.name + '.tmp')
+        pyarrow.parquet.write_table(table, tmppath, compression='zstd')
+        os.replace(tmppath, path)
+    else:
+        path.unlink()
+
+
+def _map_chunk(func, paths):
+    return [func(path) for path in paths]
 
 
 class parser():
-    def __init__(self):
-        pass
+    def __init__(self, savespath='saves'):
+        self.savespath = Path(savespath)
+        self.skipped = 0
+
+    def load(self, path):
+        return snapshot.load(path)
+
+    def iter_snapshots(self, kind=None):
+        for daypath in sorted(p for p in self.savespath.iterdir() if p.is_dir()):
+            paths = []
+            if kind in (None, 'boards'):
+                paths += sorted(daypath.glob('boards.*'))
+            if kind in (None, 'threads_on_boards'):
+                paths += sorted(daypath.glob('threads_on_boards/*'))
+            if kind in (None, 'threads'):
+                paths += sorted(daypath.glob('threads/*/*'))
+            for path in paths:
+                # Skip snapshots left half written by an interrupted save
+                if not path.name.endswith('.tmp'):
+                    yield path
+
+    def replay(self, kind=None, workers=None, chunksize=16):
+        # Decoded in a process pool and yielded in save order, so each thread's captures arrive chronologically
+        for record in self._map(decode, (str(path) for path in self.iter_snapshots(kind)), workers, chunksize):
+            if not self._skip(record):
+                yield record
+
+    def _skip(self, record):
+        if record[0] != 'error':
+            return False
+        error = record[3][0][1]
+        logger.warning(f'Skipping unreadable save {error["path"]}: {error["error"]}')
+        self.skipped += 1
+        return True
+
+    def _map(self, func, paths, workers=None, chunksize=16):
+        if workers == 1:
+            yield from map(func, paths)
+            return
+        # Only a few chunks are submitted ahead of the consumer, so memory stays flat however many saves there are
+        paths = iter(paths)
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while True:
+                while len(pending) < 2 * (workers or os.cpu_count()):
+                    chunk = list(islice(paths, chunksize))
+                    if not chunk:
+                        break
+                    pending.append(pool.submit(_map_chunk, func, chunk))
+                if not pending:
+                    return
+                yield from pending.popleft().result()
+
+    def export_parquet(self, outpath='export', workers=None, chunksize=16):
+        # Converts thread saves into posts/ and threads/ Parquet datasets partitioned as board=<board>/day=<day>.
+        # Threads with a new or changed save are exported again from all of their saves into new part
+        # files; only the older parts that held those threads are rewritten
+        if pyarrow is None:
+            raise ImportError('Parquet export requested but pyarrow is not installed')
+        outpath = Path(outpath)
+        outpath.mkdir(parents=True, exist_ok=True)
+        manifest_path = outpath / EXPORT_MANIFEST
+        manifest = {'version': EXPORT_VERSION, 'saves': {}, 'threads': {}}
+        if manifest_path.exists():
+            with open(manifest_path) as infile:
+                manifest = json.load(infile)
+            if manifest.get('version') != EXPORT_VERSION:
+                raise ValueError(f'{outpath} holds an export in an older layout, export into a new folder')
+        if 'pending' in manifest:
+            self._finish_export(outpath, manifest)
+        for orphan in outpath.glob('*/*/*/.part-*'):
+            # Written by an export that stopped before recording it
+            orphan.unlink()
+
+        saves = {}
+        for path in self.iter_snapshots('threads'):
+            stat = path.stat()
+            saves.setdefault(f'{path.parent.name}/{path.name.split("_")[0]}', []).append((str(path), str(path.relative_to(self.savespath)), [stat.st_mtime_ns, stat.st_size]))
+        changed = [key for key, entries in saves.items() if any(manifest['saves'].get(relpath) != stat for _, relpath, stat in entries)]
+
+        tables = {}
+        strip = {}
+        threads = {}
+        skipped = self.skipped
+        counts = {'threads': 0, 'files': 0}
+        for key, (board, op_id, posts, captures, errors) in zip(changed, self._map(export_tables, [[path for path, _, _ in saves[key]] for key in changed], workers, chunksize)):
+            failed = {error[3][0][1]['path'] for error in errors}
+            for error in errors:
+                self._skip(error)
+            for dataset in EXPORT_DATASETS:
+                for part in manifest['threads'].get(key, {}).get(dataset, []):
+                    strip.setdefault(part, set()).add(op_id)
+            for dataset, by_day in (('posts', posts), ('threads', captures)):
+                for day, table in by_day.items():
+                    tables.setdefault((dataset, board, day), []).append((key, table))
+            threads[key] = {dataset: [] for dataset in EXPORT_DATASETS}
+            # Saves that failed stay out of the manifest, so the next export tries the thread again
+            for path, relpath, stat in saves[key]:
+                if path not in failed:
+                    manifest['saves'][relpath] = stat
+                    counts['files'] += 1
+            counts['threads'] += 1
+
+        counts.update({'skipped': self.skipped - skipped, 'partitions': len(tables), 'posts': 0, 'thread_captures': 0, 'parts_rewritten': len(strip)})
+        renames = []
+        for (dataset, board, day), parts in tables.items():
+            folder = outpath / dataset / f'board={board}' / f'day={day}'
+            folder.mkdir(parents=True, exist_ok=True)
+            name = f'part-{time.time_ns()}.parquet'
+            merged = pyarrow.concat_tables([table for _, table in parts]).sort_by([('thread', 'ascending')])
+            # Hidden until the manifest records it, as dataset readers skip names starting with a dot
+            pyarrow.parquet.write_table(merged, folder / ('.' + name), compression='zstd')
+            part = str((folder / name).relative_to(outpath))
+            renames.append([str((folder / ('.' + name)).relative_to(outpath)), part])
+            for key, _ in parts:
+                threads[key][dataset].append(part)
+            counts['posts' if dataset == 'posts' else 'thread_captures'] += merged.num_rows
+        manifest['threads'].update(threads)
+        manifest['pending'] = {'renames': renames, 'strip': {part: sorted(ids) for part, ids in strip.items()}}
+        self._write_manifest(manifest_path, manifest)
+        self._finish_export(outpath, manifest)
+        return counts
+
+    def _finish_export(self, outpath, manifest):
+        # Both steps can be repeated, so an export interrupted after its manifest was written is
+        # completed by the next one
+        pending = manifest['pending']
+        for part, ids in pending['strip'].items():
+            _strip_part(outpath / part, ids)
+        for hidden, part in pending['renames']:
+            if (outpath / hidden).exists():
+                os.replace(outpath / hidden, outpath / part)
+        del manifest['pending']
+        self._write_manifest(outpath / EXPORT_MANIFEST, manifest)
+
+    def _write_manifest(self, manifest_path, manifest):
+        tmppath = manifest_path.with_name(manifest_path.name + '.tmp')
+        with open(tmppath, 'w') as outfile:
+            json.dump(manifest, outfile)
+        os.replace(tmppath, manifest_path)
+
+    def rebuild(self, workers=None, posts_path=None):
+        # Rebuilds the post history store, snapshot index and crawl state from the raw saves
+        store = poststore(self.savespath / 'posts.sqlite' if posts_path is None else posts_path)
+        index = snapshotindex(self.savespath / 'index.sqlite')
+        index.rebuild(self.savespath)
+        cursors = {}
+        captured_state = {}
+        threadlists = {}
+        counts = {'files': 0, 'captures': 0, 'post_versions': 0}
+        skipped = self.skipped
+        try:
+            for kind, board, op_id, captures in self.replay(workers=workers):
+                counts['files'] += 1
+                if kind == 'thread':
+                    for captured, posts in captures:
+                        counts['post_versions'] += store.store(board, op_id, {'posts': posts}, captured=captured)
+                        counts['captures'] += 1
+                    store.forget(board, op_id)
+                    posts = captures[-1][1] if captures else []
+                    if posts:
+                        cursors[(board, op_id)] = max(post['no'] for post in posts)
+                        captured_state.setdefault(board, {})[str(op_id)] = [max(post.get('time', 0) for post in posts), int(posts[0].get('replies', len(posts) - 1))]
+                elif kind == 'threadlist':
+                    captured, listed = captures[-1]
+                    if board not in threadlists or captured >= threadlists[board][0]:
+                        threadlists[board] = (captured, listed)
+            index.set_cursors(cursors)
+        finally:
+            index.close()
+            store.close()
+
+        # Threads gone from the newest thread list are not resumed; where our capture is
+        # as far along as the list, the list's last_modified is the better cursor
+        state = {}
+        for board, threads in captured_state.items():
+            listed = threadlists.get(board, (None, None))[1]
+            state[board] = {}
+            for op_id, values in threads.items():
+                if listed is None:
+                    state[board][op_id] = values
+                elif int(op_id) in listed:
+                    state[board][op_id] = listed[int(op_id)] if values[1] >= listed[int(op_id)][1] else values
+        crawlcheckpoint(self.savespath).save(state)
+        counts['threads'] = sum(len(threads) for threads in captured_state.values())
+        counts['skipped'] = self.skipped - skipped
+        return counts
+
+    def index_text(self, workers=None, text_path=None):
+        # Adds every saved post to the full-text index; posts already indexed are skipped,
+        # so this also catches an existing index up with the saves
+        index = textindex(self.savespath / 'text.sqlite' if text_path is None else text_path)
+        try:
+            for kind, board, op_id, captures in self.replay('threads', workers):
+                for captured, posts in captures:
+                    index.add(board, op_id, posts)
+            if (self.savespath / 'posts.sqlite').exists():
+                store = poststore(self.savespath / 'posts.sqlite')
+                try:
+                    for board, op_id, post in store.first_versions():
+                        index.add(board, op_id, [post])
+                finally:
+                    store.close()
+            index.flush()
+            return index.indexed
+        finally:
+            index.close()
+
+    def thread_at(self, board, op_id, at=None):
+        # Threads saved with storage_mode='posts', as of their last capture at or before `at`
+        store = poststore(self.savespath / 'posts.sqlite')
+        try:
+            return store.thread_at(board, op_id, at)
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Replay, rebuild or export saved captures, or index their text')
+    arg_parser.add_argument('command', choices=('replay', 'rebuild', 'textindex', 'export'))
+    arg_parser.add_argument('--saves', default='saves')
+    arg_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    arg_parser.add_argument('--out', default='export', help='folder for the Parquet datasets written by export')
+    arg_parser.add_argument('--kind', choices=('boards', 'threads_on_boards', 'threads'), default=None, help='only replay this kind of save')
+    args = arg_parser.parse_args()
+    saves_parser = parser(args.saves)
+    if args.command == 'replay':
+        # One JSON line per decoded file: kind, board, op id and its (captured, content) states
+        for result in saves_parser.replay(args.kind, args.workers):
+            print(json.dumps(result, separators=(',', ':')))
+    elif args.command == 'export':
+        print(json.dumps(saves_parser.export_parquet(args.out, args.workers)))
+    elif args.command == 'textindex':
+        print(json.dumps({'posts_indexed': saves_parser.index_text(args.workers), 'skipped': saves_parser.skipped}))
+    else:
+        print(json.dumps(saves_parser.rebuild(args.workers)))
 
 
 # board_in = Path() / 'saves' / '2021_01_30_10' / 'boards.json'
@@ -24,7 +421,3 @@ class parser():
 #         for thread in page['threads']:
 #             codes.append((thread['no'], thread['last_modified'], thread['replies']))
 #     print(codes)
-
-
-outpath = Path() / 'saves' / '2021_01_30_13' / 'threads' / 'r'
-for previous_thread_files in outpath.iterdir():
\ No newline at end of file
@@ -0,0 +1,194 @@
+import sys
+import json
+import time
+import logging
+import argparse
+import sqlite3
+import resource
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+
+import snapshot
+from mockapi import mockapi
+from requester import chan4requester
+
+
+class requestrecorder():
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.bytes = 0
+        self.stopped = False
+        self._lock = threading.Lock()
+
+    def __call__(self, url, status, seconds, size):
+        with self._lock:
+            if self.stopped:
+                return
+            self.latencies.append(seconds)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes += size
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+
+    def percentile(self, fraction):
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)]
+
+
+def _captured_posts(savespath):
+    posts = set()
+    threads = set()
+    written = 0
+    for path in savespath.glob('*/threads/*/*'):
+        if path.name.endswith('.tmp'):
+            continue
+        written += path.stat().st_size
+        board = path.parent.name
+        if snapshot.is_lines(path):
+            for record in snapshot.iter_lines(path):
+                if record['op'] == 'post':
+                    posts.add((board, record['post']['no']))
+                    threads.add((board, record['post']['resto'] or record['post']['no']))
+            continue
+        for post in snapshot.load(path)['posts']:
+            posts.add((board, post['no']))
+            threads.add((board, post['resto'] or post['no']))
+    if (savespath / 'posts.sqlite').exists():
+        with sqlite3.connect(savespath / 'posts.sqlite') as db:
+            for board, no, op_id in db.execute('SELECT DISTINCT board, no, op_id FROM posts'):
+                posts.add((board, no))
+                threads.add((board, op_id))
+        written += sum(path.stat().st_size for path in savespath.glob('posts.sqlite*'))
+    return posts, threads, written
+
+
+def _folder_size(path):
+    return sum(child.stat().st_size for child in Path(path).rglob('*') if child.is_file())
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _measure(url, savepath, duration, requester_kwargs, results):
+    # Runs in a process of its own, so peak RSS covers the requester and not the mock API
+    recorder = requestrecorder()
+    requester_instance = chan4requester(False, api_url=url, media_url=url, savepath=savepath, request_observer=recorder, **requester_kwargs)
+    start = time.perf_counter()
+    requester_instance.begin_monitoring()
+    time.sleep(duration)
+    requester_instance.end_monitoring()
+    # Requests made while shutting down are outside the measured run
+    recorder.stop()
+    elapsed = time.perf_counter() - start
+    requester_instance.__exit__(None, None, None)
+    results.put({
+        'duration': elapsed,
+        'requests': len(recorder.latencies),
+        'statuses': {str(status): count for status, count in sorted(recorder.statuses.items())},
+        'latency_p50': recorder.percentile(0.5),
+        'latency_p99': recorder.percentile(0.99),
+        'bytes_received': recorder.bytes,
+        'peak_rss': _peak_rss(),
+    })
+
+
+def run(duration=60, boards=3, threads=100, post_rate=2.0, thread_rate=0.05, latency=0.02, error_rate=0.0, seed=0, **requester_kwargs):
+    api = mockapi(boards, threads, post_rate, thread_rate, latency, error_rate=error_rate, seed=seed)
+    url = api.start()
+    requester_kwargs.setdefault('request_time_limit', 0.01)
+    requester_kwargs.setdefault('media_request_time_limit', requester_kwargs['request_time_limit'])
+    requester_kwargs.setdefault('min_poll_interval', 1)
+    requester_kwargs.setdefault('max_poll_interval', 10)
+    requester_kwargs.setdefault('stream_log_level', logging.WARNING)
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    try:
+        with tempfile.TemporaryDirectory(prefix='4chan_benchmark_') as savepath:
+            process = context.Process(target=_measure, args=(url, savepath, duration, requester_kwargs, results), name='benchmark_requester')
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f'Benchmarked requester exited with code {process.exitcode}')
+            measured = results.get()
+            posts, captured_threads, snapshot_bytes = _captured_posts(Path(savepath) / 'saves')
+            bytes_written = _folder_size(Path(savepath) / 'saves')
+    finally:
+        api.stop()
+    elapsed = measured['duration']
+    return {
+        'duration': elapsed,
+        'requests': measured['requests'],
+        'statuses': measured['statuses'],
+        'posts_created': api.posts_created,
+        'posts_captured': len(posts),
+        'threads_captured': len(captured_threads),
+        'threads_per_second': len(captured_threads) / elapsed,
+        'posts_per_second': len(posts) / elapsed,
+        'requests_per_post': measured['requests'] / len(posts) if posts else float('inf'),
+        'latency_p50': measured['latency_p50'],
+        'latency_p99': measured['latency_p99'],
+        'bytes_received': measured['bytes_received'],
+        'snapshot_bytes': snapshot_bytes,
+        'bytes_written': bytes_written,
+        'peak_rss': measured['peak_rss'],
+    }
+
+
+# Metrics where a larger value is a regression; everything else compared is better when larger
+LOWER_IS_BETTER = ('requests_per_post', 'latency_p50', 'latency_p99', 'bytes_written', 'peak_rss')
+HIGHER_IS_BETTER = ('threads_per_second', 'posts_per_second')
+
+
+def compare(result, baseline, tolerance=0.1):
+    regressions = []
+    for key in LOWER_IS_BETTER:
+        if key in baseline and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f'{key} rose from {baseline[key]:.4g} to {result[key]:.4g}')
+    for key in HIGHER_IS_BETTER:
+        if key in baseline and result[key] < baseline[key] * (1 - tolerance):
+            regressions.append(f'{key} fell from {baseline[key]:.4g} to {result[key]:.4g}')
+    return regressions
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Run the requester against the mock API and report capture throughput')
+    arg_parser.add_argument('--duration', type=float, default=60)
+    arg_parser.add_argument('--boards', type=int, default=3)
+    arg_parser.add_argument('--threads', type=int, default=100)
+    arg_parser.add_argument('--post-rate', type=float, default=2.0, help='replies per second per board')
+    arg_parser.add_argument('--thread-rate', type=float, default=0.05, help='new threads per second per board')
+    arg_parser.add_argument('--latency', type=float, default=0.02)
+    arg_parser.add_argument('--error-rate', type=float, default=0.0)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--storage-mode', default='snapshot')
+    arg_parser.add_argument('--refresh-mode', default='thread')
+    arg_parser.add_argument('--max-in-flight', type=int, default=4)
+    arg_parser.add_argument('--media-mode', default=None, help='full or thumbnail to also download media')
+    arg_parser.add_argument('--output', default=None, help='write the results as JSON to this path')
+    arg_parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare against')
+    arg_parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative change before a metric counts as a regression')
+    args = arg_parser.parse_args()
+
+    result = run(args.duration, args.boards, args.threads, args.post_rate, args.thread_rate, args.latency, args.error_rate, args.seed,
+                 storage_mode=args.storage_mode, refresh_mode=args.refresh_mode, max_in_flight=args.max_in_flight, media_mode=args.media_mode)
+    for key, value in result.items():
+        print(f'{key}: {value:.4g}' if isinstance(value, float) else f'{key}: {value}')
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            json.dump(result, outfile, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as infile:
+            regressions = compare(result, json.load(infile), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        sys.exit(1 if regressions else 0)
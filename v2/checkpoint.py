@@ -0,0 +1,50 @@
+import time
+from pathlib import Path
+
+import snapshot
+from snapshot import snapshotformat
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_NAME = 'crawl_state'
+
+
+class crawlcheckpoint():
+    def __init__(self, folderpath, worker_id=None, interval=60):
+        self.folderpath = Path(folderpath)
+        self.interval = interval
+        self._format = snapshotformat('compact', 'gzip')
+        name = CHECKPOINT_NAME if worker_id is None else CHECKPOINT_NAME + '_' + worker_id
+        self.path = self.folderpath / (name + self._format.suffix)
+        self._last_saved = time.time()
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        return now - self._last_saved >= self.interval
+
+    def save(self, capture_cursors, now=None, board_saved=None):
+        # board_saved holds older times for boards this worker no longer owns, so a fresher
+        # checkpoint from their new owner wins the merge in load
+        now = time.time() if now is None else now
+        board_saved = {} if board_saved is None else board_saved
+        self.folderpath.mkdir(parents=True, exist_ok=True)
+        self._format.dump({'version': CHECKPOINT_VERSION, 'saved': now, 'threads': capture_cursors, 'board_saved': {board: board_saved.get(board, now) for board in capture_cursors}}, self.path)
+        self._last_saved = now
+
+    def load(self, boards=None):
+        # Other workers' checkpoints are merged in so boards taken over from them start warm
+        merged = {}
+        saved_at = {}
+        for path in sorted(self.folderpath.glob(CHECKPOINT_NAME + '*')):
+            if path.name.endswith('.tmp'):
+                continue
+            state = snapshot.load(path)
+            if state.get('version') != CHECKPOINT_VERSION:
+                continue
+            for board, threads in state['threads'].items():
+                if boards is not None and board not in boards:
+                    continue
+                saved = state.get('board_saved', {}).get(board, state['saved'])
+                if board not in merged or saved > saved_at[board]:
+                    merged[board] = threads
+                    saved_at[board] = saved
+        return merged if saved_at else None
@@ -0,0 +1,97 @@
+import time
+from pathlib import Path
+
+import snapshot
+from posts import post_digest
+
+
+class deltastore():
+    def __init__(self, index, snapshot_format=None, writer=None):
+        self._index = index
+        self._writer = writer
+        self._format = snapshot.snapshotformat() if snapshot_format is None else snapshot_format
+        self._digests = {}
+        self._heads = {}
+
+    def _replay(self, path):
+        posts = {}
+        if not path.exists():
+            return posts
+        for record in snapshot.iter_lines(path):
+            if record['op'] == 'post':
+                posts[record['post']['no']] = record['post']
+            elif record['op'] == 'patch':
+                post = posts.setdefault(record['no'], {'no': record['no']})
+                post.update(record['set'])
+                for key in record['unset']:
+                    post.pop(key, None)
+            elif record['op'] == 'delete':
+                posts.pop(record['no'], None)
+        return posts
+
+    def _load(self, key, path):
+        # Only the OP is kept whole since it is the post whose counters change;
+        # replies are kept as digests and replayed from disk on the rare edit
+        posts = self._replay(path)
+        self._digests[key] = {no: post_digest(post) for no, post in posts.items()}
+        self._heads[key] = posts.get(key[1])
+
+    def append(self, board_code, op_ID, path, thread_json, complete=True):
+        # An incomplete thread_json (e.g. built from the catalog) only adds posts and
+        # patches the OP; posts it does not mention are not treated as deleted
+        path = Path(path)
+        key = (board_code, int(op_ID))
+        if key not in self._digests:
+            self._load(key, path)
+        known = self._digests[key]
+        cursor = self._index.get_cursor(board_code, op_ID) or max(known, default=0)
+        captured = time.time()
+
+        records = []
+        current = set()
+        replayed = None
+        for post in thread_json['posts']:
+            no = post['no']
+            current.add(no)
+            if not complete and no != key[1] and no in known:
+                continue
+            if not complete and no == key[1] and self._heads[key] is not None:
+                post = dict(self._heads[key], **post)
+            digest = post_digest(post)
+            if no > cursor or no not in known:
+                records.append({'op': 'post', 'captured': captured, 'post': post})
+            elif digest != known[no]:
+                if no == key[1] and self._heads[key] is not None:
+                    old = self._heads[key]
+                else:
+                    if replayed is None:
+                        replayed = self._replay(path)
+                    old = replayed.get(no, {})
+                changed = {k: v for k, v in post.items() if old.get(k) != v}
+                removed = [k for k in old if k not in post]
+                records.append({'op': 'patch', 'captured': captured, 'no': no, 'set': changed, 'unset': removed})
+            known[no] = digest
+            if no == key[1]:
+                self._heads[key] = post
+        for no in [no for no in known if complete and no not in current]:
+            records.append({'op': 'delete', 'captured': captured, 'no': no})
+            del known[no]
+
+        if records:
+            if self._writer is None:
+                self._write(records, path)
+            else:
+                self._writer.submit(('thread', board_code, int(op_ID)), self._write, records, path)
+        new_cursor = max(cursor, max(current, default=0))
+        if new_cursor != cursor:
+            self._index.set_cursor(board_code, op_ID, new_cursor)
+        return len(records)
+
+    def _write(self, records, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._format.append_lines(records, path)
+        return [path]
+
+    def forget(self, board_code, op_ID):
+        self._digests.pop((board_code, int(op_ID)), None)
+        self._heads.pop((board_code, int(op_ID)), None)
@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+from pathlib import Path
+
+from posts import post_digest
+
+SEGMENT_PREFIX = 'events_'
+SEGMENT_SUFFIX = '.jsonl'
+OFFSETS_NAME = 'offsets.json'
+# OP counters change with every reply, so they are left out when looking for edits
+COUNTER_FIELDS = ('replies', 'images', 'unique_ips', 'omitted_posts', 'omitted_images')
+
+
+def _edit_digest(post):
+    return post_digest({field: value for field, value in post.items() if field not in COUNTER_FIELDS})
+
+
+def _encode(event):
+    return (json.dumps(event, separators=(',', ':')) + '\n').encode()
+
+
+class stdoutsink():
+    def __init__(self, stream=None):
+        self._stream = sys.stdout.buffer if stream is None else stream
+
+    def send(self, events):
+        self._stream.write(b''.join(_encode(event) for event in events))
+        self._stream.flush()
+
+    def close(self):
+        pass
+
+
+class socketsink():
+    def __init__(self, address, send_timeout=1.0, logger=None):
+        # address is a filesystem path for a Unix socket or a (host, port) tuple for TCP
+        self.address = address
+        self.send_timeout = send_timeout
+        self._logger = logger
+        self._clients = []
+        self._lock = threading.Lock()
+        if isinstance(address, tuple):
+            self._server = socket.create_server(address)
+        else:
+            Path(address).unlink(missing_ok=True)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(address)
+            self._server.listen()
+        self._accepting = True
+        self._thread = threading.Thread(target=self._accept, name='event_socket', daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while self._accepting:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return
+            client.settimeout(self.send_timeout)
+            with self._lock:
+                self._clients.append(client)
+
+    def send(self, events):
+        raw = b''.join(_encode(event) for event in events)
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.sendall(raw)
+            except OSError:
+                # Consumers that cannot keep up are dropped rather than slowing capture
+                if self._logger is not None:
+                    self._logger.warning(f'Dropping event stream consumer on {self.address}')
+                with self._lock:
+                    self._clients.remove(client)
+                client.close()
+
+    def close(self):
+        self._accepting = False
+        self._server.close()
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients = []
+        if not isinstance(self.address, tuple):
+            Path(self.address).unlink(missing_ok=True)
+
+
+class segmentlog():
+    def __init__(self, folderpath, segment_bytes=64 * 1024 * 1024, max_segments=None):
+        # Events get consecutive offsets; each segment file is named after the offset of its first event
+        self.folderpath = Path(folderpath)
+        self.folderpath.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        segments = self.segments()
+        self._segment = segments[-1] if segments else None
+        self.next_offset = 0
+        if self._segment is not None:
+            with open(self._segment, 'rb') as infile:
+                self.next_offset = self._first_offset(self._segment) + sum(1 for line in infile if line.endswith(b'\n'))
+
+    @staticmethod
+    def _first_offset(path):
+        return int(path.name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def segments(self):
+        return sorted(self.folderpath.glob(SEGMENT_PREFIX + '*' + SEGMENT_SUFFIX), key=self._first_offset)
+
+    def send(self, events):
+        with self._lock:
+            if self._segment is None or self._segment.stat().st_size >= self.segment_bytes:
+                self._segment = self.folderpath / f'{SEGMENT_PREFIX}{self.next_offset:020d}{SEGMENT_SUFFIX}'
+                self._expire()
+            lines = []
+            for event in events:
+                lines.append(_encode(dict(event, offset=self.next_offset)))
+                self.next_offset += 1
+            with open(self._segment, 'ab') as outfile:
+                outfile.write(b''.join(lines))
+
+    def _expire(self):
+        if self.max_segments is None:
+            return
+        segments = self.segments()
+        for path in segments[:max(len(segments) + 1 - self.max_segments, 0)]:
+            path.unlink(missing_ok=True)
+
+    def read(self, offset=0, limit=None):
+        # Yields events from offset onwards; a partially written last line is left for the next read
+        count = 0
+        segments = self.segments()
+        for i, path in enumerate(segments):
+            if i + 1 < len(segments) and self._first_offset(segments[i + 1]) <= offset:
+                continue
+            current = self._first_offset(path)
+            with open(path, 'rb') as infile:
+                for line in infile:
+                    if not line.endswith(b'\n'):
+                        return
+                    if current >= offset:
+                        yield json.loads(line)
+                        count += 1
+                        if limit is not None and count >= limit:
+                            return
+                    current += 1
+
+    def committed(self, consumer):
+        path = self.folderpath / OFFSETS_NAME
+        if not path.exists():
+            return 0
+        with open(path) as infile:
+            return json.load(infile).get(consumer, 0)
+
+    def commit(self, consumer, offset):
+        # offset is the next event the consumer wants, i.e. last processed offset + 1
+        with self._lock:
+            path = self.folderpath / OFFSETS_NAME
+            offsets = {}
+            if path.exists():
+                with open(path) as infile:
+                    offsets = json.load(infile)
+            offsets[consumer] = offset
+            tmppath = path.with_name(path.name + '.tmp')
+            with open(tmppath, 'w') as outfile:
+                json.dump(offsets, outfile)
+            os.replace(tmppath, path)
+
+    def close(self):
+        pass
+
+
+def make_sink(spec, logger=None):
+    # 'stdout', 'unix:/path/to.sock', 'tcp:host:port' or 'log:/path/to/folder'
+    if not isinstance(spec, str):
+        return spec
+    if spec == 'stdout':
+        return stdoutsink()
+    kind, _, target = spec.partition(':')
+    if kind == 'unix':
+        return socketsink(target, logger=logger)
+    if kind == 'tcp':
+        host, _, port = target.rpartition(':')
+        return socketsink((host or '127.0.0.1', int(port)), logger=logger)
+    if kind == 'log':
+        return segmentlog(target)
+    raise ValueError(f'Unknown event sink {spec}, expected stdout, unix:<path>, tcp:<host>:<port> or log:<folder>')
+
+
+class eventstream():
+    def __init__(self, sinks, max_queued=100000, batch_size=256, logger=None):
+        self.sinks = [make_sink(sink, logger) for sink in sinks]
+        self.batch_size = batch_size
+        self.published = 0
+        self.dropped = 0
+        self._logger = logger
+        self._digests = {}
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._run, name='event_stream', daemon=True)
+        self._thread.start()
+
+    def posts(self, board_code, op_ID, posts, cursor=None, complete=True):
+        # The first sight of a thread after a restart only records posts up to the capture cursor,
+        # so they are not announced twice; edits are only detectable once a thread has been seen
+        key = (board_code, int(op_ID))
+        captured = time.time()
+        known = self._digests.get(key)
+        baseline = known is None
+        if baseline:
+            known = self._digests[key] = {}
+        current = set()
+        for post in posts:
+            no = post['no']
+            current.add(no)
+            # A catalog OP lacks some thread fields, so it is neither an edit nor the new baseline
+            if not complete and no == key[1] and no in known:
+                continue
+            digest = _edit_digest(post)
+            previous = known.get(no)
+            known[no] = digest
+            if previous is None:
+                if baseline and cursor is not None and no <= cursor:
+                    continue
+                self.publish({'type': 'post', 'board': board_code, 'thread': key[1], 'no': no, 'captured': captured, 'post': post})
+            elif previous != digest:
+                self.publish({'type': 'edit', 'board': board_code, 'thread': key[1], 'no': no, 'captured': captured, 'post': post})
+        if complete and not baseline:
+            for no in [no for no in known if no not in current]:
+                del known[no]
+                self.publish({'type': 'delete', 'board': board_code, 'thread': key[1], 'no': no, 'captured': captured})
+
+    def death(self, board_code, op_ID, reason):
+        self.forget(board_code, op_ID)
+        self.publish({'type': 'death', 'board': board_code, 'thread': int(op_ID), 'reason': reason, 'captured': time.time()})
+
+    def forget(self, board_code, op_ID):
+        self._digests.pop((board_code, int(op_ID)), None)
+
+    def publish(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            if self._logger is not None and self.dropped % 1000 == 1:
+                self._logger.warning(f'Event queue full, {self.dropped} events dropped so far')
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [event for event in batch if event is not None]
+            for sink in self.sinks:
+                try:
+                    sink.send(batch)
+                except Exception:
+                    if self._logger is not None:
+                        self._logger.exception(f'Event sink {sink.__class__.__name__} failed')
+            self.published += len(batch)
+            for _ in range(len(batch) + (0 if running else 1)):
+                self._queue.task_done()
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        for sink in self.sinks:
+            sink.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Read events from a segment log, resuming from a consumer offset')
+    arg_parser.add_argument('folder')
+    arg_parser.add_argument('--consumer', default=None, help='resume from and commit this consumer offset')
+    arg_parser.add_argument('--offset', type=int, default=None, help='start from this offset instead')
+    arg_parser.add_argument('--follow', action='store_true', help='keep waiting for new events')
+    args = arg_parser.parse_args()
+    log = segmentlog(args.folder)
+    offset = args.offset if args.offset is not None else (log.committed(args.consumer) if args.consumer else 0)
+    try:
+        while True:
+            for event in log.read(offset):
+                sys.stdout.write(json.dumps(event, separators=(',', ':')) + '\n')
+                offset = event['offset'] + 1
+            sys.stdout.flush()
+            if args.consumer:
+                log.commit(args.consumer, offset)
+            if not args.follow:
+                break
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        if args.consumer:
+            log.commit(args.consumer, offset)
@@ -0,0 +1,148 @@
+import asyncio
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+NOT_MODIFIED = object()
+# Connect and read timeouts in seconds, so a stalled connection cannot hold a request slot forever
+HTTP_TIMEOUT = (10, 30)
+
+
+class tokenbucket():
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.total_wait = 0.0
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    async def acquire(self):
+        # Created lazily so the lock is bound to the engine's event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                wait = (1 - self._tokens) / self.rate
+                await asyncio.sleep(wait)
+                self.total_wait += wait
+                self._refill()
+            self._tokens -= 1
+
+
+class httpclient():
+    def __init__(self, pool_size=4, timeout=HTTP_TIMEOUT):
+        self.timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._last_modified = {}
+        self._observers = []
+
+    def add_observer(self, observer):
+        # Observers are called as observer(url, status_code, seconds, size) after every response
+        self._observers.append(observer)
+
+    def get(self, url, conditional=False):
+        headers = {}
+        if conditional and url in self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified[url]
+        start = time.perf_counter()
+        response = self._session.get(url, headers=headers, timeout=self.timeout)
+        elapsed = time.perf_counter() - start
+        if response.status_code == 200 and 'Last-Modified' in response.headers:
+            self._last_modified[url] = response.headers['Last-Modified']
+        for observer in self._observers:
+            observer(url, response.status_code, elapsed, len(response.content))
+        return response
+
+    def last_modified(self, url):
+        # Last-Modified of the latest 200 for url as a timestamp, or None
+        if url not in self._last_modified:
+            return None
+        try:
+            return parsedate_to_datetime(self._last_modified[url]).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def forget(self, url):
+        self._last_modified.pop(url, None)
+
+    def close(self):
+        self._session.close()
+
+
+class fetchengine():
+    def __init__(self, request_time_limit=1, max_in_flight=4, logger=None, timeout=HTTP_TIMEOUT):
+        self.rate_limiter = tokenbucket(1 / request_time_limit)
+        self.max_in_flight = max_in_flight
+        self._logger = logger
+        # Bound to the engine's loop on first use, so it can be created here before the loop runs
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self.http = httpclient(max_in_flight, timeout)
+
+        self._loop = asyncio.new_event_loop()
+        self._http_executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='fetch_http')
+        self._job_executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='fetch_job')
+        self._loop_thread = threading.Thread(target=self._run_loop, name='fetch_engine', daemon=True)
+        self._loop_thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    async def fetch(self, url, conditional=False):
+        async with self._in_flight:
+            await self.rate_limiter.acquire()
+            return await self._loop.run_in_executor(self._http_executor, partial(self.http.get, url, conditional))
+
+    async def fetch_all(self, urls, conditional=False):
+        return await asyncio.gather(*[self.fetch(url, conditional) for url in urls])
+
+    def get(self, url, conditional=False):
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, conditional), self._loop).result()
+
+    def get_all(self, urls, conditional=False):
+        return asyncio.run_coroutine_threadsafe(self.fetch_all(urls, conditional), self._loop).result()
+
+    def submit(self, func, *args):
+        return self._job_executor.submit(func, *args)
+
+    def run_concurrently(self, func, jobs, keep_running=None):
+        # Stopping cancels the jobs not yet started but still waits for the running ones, so none is
+        # left writing once this returns. A job that raises is logged and skipped
+        futures = {self._job_executor.submit(func, *job): job for job in jobs}
+        stopping = False
+        for future in as_completed(futures):
+            if not stopping and keep_running is not None and not keep_running():
+                stopping = True
+                for pending in futures:
+                    pending.cancel()
+            if future.cancelled():
+                continue
+            try:
+                future.result()
+            except Exception:
+                if self._logger is not None:
+                    self._logger.exception(f'Job {futures[future]} failed')
+                continue
+            yield futures[future]
+
+    def close(self):
+        self._job_executor.shutdown(wait=True)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._http_executor.shutdown(wait=True)
+        self.http.close()
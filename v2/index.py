@@ -0,0 +1,141 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class snapshotindex():
+    def __init__(self, dbpath):
+        dbpath = Path(dbpath)
+        dbpath.parent.mkdir(parents=True, exist_ok=True)
+        self.is_new = not dbpath.exists()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(dbpath, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS threads (board TEXT, op_id INTEGER, path TEXT, captured REAL, PRIMARY KEY (board, op_id))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS threadlists (board TEXT PRIMARY KEY, path TEXT, captured REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cursors (board TEXT, op_id INTEGER, cursor INTEGER, PRIMARY KEY (board, op_id))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS closed (board TEXT, op_id INTEGER, reason TEXT, closed REAL, PRIMARY KEY (board, op_id))')
+        self._db.commit()
+
+        self._threads = {}
+        for board, op_id, path, captured in self._db.execute('SELECT board, op_id, path, captured FROM threads'):
+            self._threads[(board, op_id)] = (Path(path), captured)
+        self._threadlists = {}
+        for board, path, captured in self._db.execute('SELECT board, path, captured FROM threadlists'):
+            self._threadlists[board] = (Path(path), captured)
+        self._cursors = {}
+        for board, op_id, cursor in self._db.execute('SELECT board, op_id, cursor FROM cursors'):
+            self._cursors[(board, op_id)] = cursor
+
+    def _thread_entry(self, board_code, op_ID):
+        key = (board_code, int(op_ID))
+        entry = self._threads.get(key)
+        if entry is None:
+            # Another worker sharing the index may have captured it since the cache was loaded
+            with self._lock:
+                row = self._db.execute('SELECT path, captured FROM threads WHERE board = ? AND op_id = ?', key).fetchone()
+            if row is not None:
+                entry = self._threads[key] = (Path(row[0]), row[1])
+        return entry
+
+    def get_thread(self, board_code, op_ID):
+        entry = self._thread_entry(board_code, op_ID)
+        return None if entry is None else entry[0]
+
+    def get_thread_capture_time(self, board_code, op_ID):
+        entry = self._thread_entry(board_code, op_ID)
+        return None if entry is None else entry[1]
+
+    def set_thread(self, board_code, op_ID, path, captured=None):
+        captured = time.time() if captured is None else captured
+        self._threads[(board_code, int(op_ID))] = (Path(path), captured)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?)', (board_code, int(op_ID), str(path), captured))
+            self._db.commit()
+
+    def get_cursor(self, board_code, op_ID):
+        key = (board_code, int(op_ID))
+        cursor = self._cursors.get(key)
+        if cursor is None:
+            with self._lock:
+                row = self._db.execute('SELECT cursor FROM cursors WHERE board = ? AND op_id = ?', key).fetchone()
+            if row is not None:
+                cursor = self._cursors[key] = row[0]
+        return cursor
+
+    def set_cursor(self, board_code, op_ID, cursor):
+        self._cursors[(board_code, int(op_ID))] = cursor
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)', (board_code, int(op_ID), cursor))
+            self._db.commit()
+
+    def set_cursors(self, cursors):
+        self._cursors.update({(board_code, int(op_ID)): cursor for (board_code, op_ID), cursor in cursors.items()})
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)', [(board_code, int(op_ID), cursor) for (board_code, op_ID), cursor in cursors.items()])
+            self._db.commit()
+
+    def reload_board(self, board_code):
+        # Refreshes the cached rows of a board taken over from another worker
+        with self._lock:
+            threads = self._db.execute('SELECT op_id, path, captured FROM threads WHERE board = ?', (board_code,)).fetchall()
+            cursors = self._db.execute('SELECT op_id, cursor FROM cursors WHERE board = ?', (board_code,)).fetchall()
+            threadlist = self._db.execute('SELECT path, captured FROM threadlists WHERE board = ?', (board_code,)).fetchone()
+        for op_id, path, captured in threads:
+            self._threads[(board_code, op_id)] = (Path(path), captured)
+        for op_id, cursor in cursors:
+            self._cursors[(board_code, op_id)] = cursor
+        if threadlist is not None:
+            self._threadlists[board_code] = (Path(threadlist[0]), threadlist[1])
+
+    def close_thread(self, board_code, op_ID, reason, closed=None):
+        closed = time.time() if closed is None else closed
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO closed VALUES (?, ?, ?, ?)', (board_code, int(op_ID), reason, closed))
+            self._db.commit()
+
+    def is_closed(self, board_code, op_ID):
+        # Not cached, closed threads pile up forever and this is only asked on births
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM closed WHERE board = ? AND op_id = ?', (board_code, int(op_ID))).fetchone() is not None
+
+    def get_threadlist(self, board_code):
+        entry = self._threadlists.get(board_code)
+        return None if entry is None else entry[0]
+
+    def set_threadlist(self, board_code, path, captured=None):
+        captured = time.time() if captured is None else captured
+        self._threadlists[board_code] = (Path(path), captured)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO threadlists VALUES (?, ?, ?)', (board_code, str(path), captured))
+            self._db.commit()
+
+    def rebuild(self, savespath):
+        # Day folders and time suffixes sort chronologically, so later files win
+        savespath = Path(savespath)
+        if not savespath.exists():
+            return
+        for daypath in sorted(p for p in savespath.iterdir() if p.is_dir()):
+            threadlistpath = daypath / 'threads_on_boards'
+            if threadlistpath.exists():
+                for path in sorted(threadlistpath.iterdir()):
+                    if path.name.endswith('.tmp'):
+                        continue
+                    self._threadlists[path.name.split('_')[0]] = (path, path.stat().st_mtime)
+            threadspath = daypath / 'threads'
+            if threadspath.exists():
+                for boardpath in sorted(threadspath.iterdir()):
+                    for path in sorted(boardpath.iterdir()):
+                        if path.name.endswith('.tmp'):
+                            continue
+                        self._threads[(boardpath.name, int(path.name.split('_')[0]))] = (path, path.stat().st_mtime)
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO threadlists VALUES (?, ?, ?)', [(board, str(path), captured) for board, (path, captured) in self._threadlists.items()])
+            self._db.executemany('INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?)', [(board, op_id, str(path), captured) for (board, op_id), (path, captured) in self._threads.items()])
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
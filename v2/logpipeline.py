@@ -0,0 +1,82 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Passed as extra= on per-thread debug records so the sampler can tell them apart
+THREAD_EVENT = {'thread_event': True}
+
+
+class deferredqueuehandler(QueueHandler):
+    def prepare(self, record):
+        # The listener thread formats the record, so only the reference crosses the queue.
+        # Arguments are formatted late, so callers pass immutable values (ids, counts)
+        return record
+
+
+class threadeventsampler(logging.Filter):
+    def __init__(self, sample_every=1, max_per_second=None):
+        super().__init__()
+        self.sample_every = sample_every
+        self.max_per_second = max_per_second
+        self.suppressed = 0
+        self._seen = 0
+        self._window = 0
+        self._window_count = 0
+        self._pending_suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not getattr(record, 'thread_event', False):
+            return True
+        with self._lock:
+            self._seen += 1
+            keep = self._seen % self.sample_every == 0
+            if keep and self.max_per_second is not None:
+                window = int(time.monotonic())
+                if window != self._window:
+                    self._window = window
+                    self._window_count = 0
+                keep = self._window_count < self.max_per_second
+                self._window_count += int(keep)
+            if not keep:
+                self.suppressed += 1
+                self._pending_suppressed += 1
+                return False
+            suppressed, self._pending_suppressed = self._pending_suppressed, 0
+        if suppressed:
+            record.msg = str(record.msg) + ' (%d similar thread events suppressed)'
+            record.args = tuple(record.args or ()) + (suppressed,)
+        return True
+
+
+class asynclogging():
+    def __init__(self, logger, handlers, max_queued=100000):
+        # A full queue drops records rather than stalling the sweep
+        self.dropped = 0
+        self._logger = logger
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._handler = deferredqueuehandler(self._queue)
+        self._handler.handleError = self._count_dropped
+        self._listener = QueueListener(self._queue, *handlers, respect_handler_level=True)
+        self._listener.start()
+        logger.addHandler(self._handler)
+        atexit.register(self.close)
+
+    def _count_dropped(self, record):
+        self.dropped += 1
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        if self._listener is None:
+            return
+        self._logger.removeHandler(self._handler)
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.flush()
+        self._listener = None
@@ -0,0 +1,149 @@
+import os
+import base64
+import queue
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+from fetcher import fetchengine
+
+MEDIA_MODES = ('full', 'thumbnail')
+
+
+class mediastore():
+    def __init__(self, folderpath, mode='full', max_bytes=None, request_time_limit=1, workers=2, max_queued=10000, media_url='https://i.4cdn.org', logger=None, stored_cache=100000):
+        if mode not in MEDIA_MODES:
+            raise ValueError(f'Unknown media mode {mode}, expected one of {MEDIA_MODES}')
+        self.folderpath = Path(folderpath)
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.media_url = media_url
+        self.downloaded = 0
+        self.downloaded_bytes = 0
+        self.dropped = 0
+        self._logger = logger
+        # Queued and in-flight paths, so a file is never fetched twice at once. Stored files are found on
+        # disk; the most recently stored ones are also remembered to save a stat per repost
+        self._pending = set()
+        self._stored = OrderedDict()
+        self._stored_cache = stored_cache
+        self._seen_lock = threading.Lock()
+        self._fetcher = fetchengine(request_time_limit, workers, logger)
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._run, name=f'media_{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def path_for(self, md5, ext, thumbnail=False):
+        # Keyed by the API's md5 so a repost of the same file maps to the same path
+        digest = base64.b64decode(md5).hex()
+        name = digest + ('s.jpg' if thumbnail else ext)
+        return self.folderpath / digest[:2] / name
+
+    def submit_posts(self, board_code, posts):
+        for post in posts:
+            if 'tim' not in post or 'md5' not in post or post.get('filedeleted'):
+                continue
+            thumbnail = self.mode == 'thumbnail' or (self.max_bytes is not None and post.get('fsize', 0) > self.max_bytes)
+            path = self.path_for(post['md5'], post['ext'], thumbnail)
+            with self._seen_lock:
+                if path in self._stored:
+                    self._stored.move_to_end(path)
+                    continue
+                if path in self._pending:
+                    continue
+            if path.exists():
+                self._remember(path)
+                continue
+            with self._seen_lock:
+                if path in self._pending:
+                    continue
+                self._pending.add(path)
+            url = self.media_url + '/' + board_code + '/' + str(post['tim']) + ('s.jpg' if thumbnail else post['ext'])
+            try:
+                self._queue.put_nowait((url, path, None if thumbnail else post['md5']))
+            except queue.Full:
+                # Dropping keeps thread capture moving; the file is retried the next time the post is seen
+                with self._seen_lock:
+                    self._pending.discard(path)
+                self.dropped += 1
+                if self._logger is not None:
+                    self._logger.warning(f'Media queue full, dropped download of {url}')
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            try:
+                if self._download(*job):
+                    self._remember(job[1])
+            except Exception:
+                if self._logger is not None:
+                    self._logger.exception(f'Media download of {job[0]} failed')
+            finally:
+                # A failed download is tried again the next time the post is seen
+                with self._seen_lock:
+                    self._pending.discard(job[1])
+                self._queue.task_done()
+
+    def _remember(self, path):
+        with self._seen_lock:
+            self._stored[path] = True
+            self._stored.move_to_end(path)
+            if len(self._stored) > self._stored_cache:
+                self._stored.popitem(last=False)
+
+    def _download(self, url, path, md5):
+        response = self._fetcher.get(url)
+        if response.status_code != 200:
+            if self._logger is not None:
+                self._logger.warning(f'Media request for {url} was unsuccessful with error code {response.status_code}')
+            return False
+        content = response.content
+        if md5 is not None and base64.b64encode(hashlib.md5(content).digest()).decode() != md5:
+            if self._logger is not None:
+                self._logger.warning(f'Media from {url} does not match its md5, discarding')
+            return False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = path.with_name(path.name + '.tmp')
+        with open(tmppath, 'wb') as outfile:
+            outfile.write(content)
+        os.replace(tmppath, path)
+        self.downloaded += 1
+        self.downloaded_bytes += len(content)
+        return True
+
+    def add_observer(self, observer):
+        self._fetcher.http.add_observer(observer)
+
+    @property
+    def rate_limiter_wait(self):
+        return self._fetcher.rate_limiter.total_wait
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        # Pending downloads are discarded, the posts still reference them by md5
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.dropped += 1
+            self._queue.task_done()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._fetcher.close()
@@ -0,0 +1,188 @@
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SWEEP_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400)
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def endpoint_for(url):
+    # Maps an API or media URL to (endpoint, board) labels without one series per thread
+    parts = url.split('?')[0].rstrip('/').split('/')
+    if parts[-1] == 'boards.json':
+        return 'boards', ''
+    if len(parts) > 2 and parts[-2] == 'thread':
+        return 'thread', parts[-3]
+    if parts[-1] in ('threads.json', 'catalog.json', 'archive.json'):
+        return parts[-1][:-len('.json')], parts[-2]
+    return 'media', parts[-2]
+
+
+class metric():
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), func=None):
+        # func, when given, is called at scrape time and returns a value, or a dict of label tuples to values
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._func = func
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {labelvalues}')
+        return tuple(str(value) for value in labelvalues)
+
+    def samples(self):
+        if self._func is not None:
+            values = self._func()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for labelvalues, value in sorted(values.items()):
+            yield '', list(zip(self.labelnames, labelvalues)), value
+
+
+class counter(metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class gauge(metric):
+    kind = 'gauge'
+
+    def set(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+
+class histogram(metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        for labelvalues, (counts, total, count) in sorted(values.items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', labels + [('le', _format_value(float(bound)))], cumulative
+            yield '_bucket', labels + [('le', '+Inf')], count
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+class metricsregistry():
+    def __init__(self, namespace='chan4'):
+        self.namespace = namespace
+        self._metrics = {}
+        self._server = None
+        self._thread = None
+
+    def _register(self, cls, name, *args, **kwargs):
+        name = f'{self.namespace}_{name}' if self.namespace else name
+        if name in self._metrics:
+            raise ValueError(f'Metric {name} is already registered')
+        self._metrics[name] = cls(name, *args, **kwargs)
+        return self._metrics[name]
+
+    def counter(self, name, help, labelnames=(), func=None):
+        return self._register(counter, name, help, labelnames, func)
+
+    def gauge(self, name, help, labelnames=(), func=None):
+        return self._register(gauge, name, help, labelnames, func)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(histogram, name, help, labelnames, buckets)
+
+    def render(self):
+        lines = []
+        for name, family in self._metrics.items():
+            lines.append(f'# HELP {name} {family.help}')
+            lines.append(f'# TYPE {name} {family.kind}')
+            for suffix, labels, value in family.samples():
+                lines.append(f'{name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def _handler(self):
+        registry = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return handler
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/metrics'
+
+    def serve(self, port, host='127.0.0.1'):
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        return self.url
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
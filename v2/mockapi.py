@@ -0,0 +1,251 @@
+import json
+import time
+import random
+import base64
+import hashlib
+import argparse
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+THREADS_PER_PAGE = 15
+
+
+class mockboard():
+    def __init__(self, code, max_threads=150, post_rate=1.0, thread_rate=0.05, bump_limit=300, archived=True, image_rate=0.3, seed=None):
+        self.code = code
+        self.max_threads = max_threads
+        self.post_rate = post_rate
+        self.thread_rate = thread_rate
+        self.bump_limit = bump_limit
+        self.archived = archived
+        self.image_rate = image_rate
+        self.posts_created = 0
+        self.last_changed = time.time()
+        self._rng = random.Random(seed)
+        self._next_no = 1
+        self._threads = {}
+        self._archive = {}
+        self._media = {}
+        self._pending_posts = 0.0
+        self._pending_threads = 0.0
+        self._last_advance = time.time()
+        for _ in range(max_threads):
+            self._new_thread(self._last_advance - self._rng.uniform(0, 3600))
+
+    def _post(self, now, resto):
+        post = {'no': self._next_no, 'resto': resto, 'time': int(now), 'name': 'Anonymous', 'com': f'synthetic post {self._next_no} on /{self.code}/'}
+        self._next_no += 1
+        self.posts_created += 1
+        if self._rng.random() < self.image_rate:
+            tim = int(now * 1000) + post['no']
+            content = self._rng.randbytes(self._rng.randint(512, 4096))
+            self._media[str(tim) + '.jpg'] = content
+            self._media[str(tim) + 's.jpg'] = content[:256]
+            post.update({'tim': tim, 'ext': '.jpg', 'filename': f'image{post["no"]}', 'fsize': len(content), 'md5': base64.b64encode(hashlib.md5(content).digest()).decode(), 'w': 500, 'h': 500})
+        return post
+
+    def _new_thread(self, now):
+        op = self._post(now, 0)
+        op.update({'sub': f'thread {op["no"]}', 'replies': 0, 'images': int('tim' in op)})
+        self._threads[op['no']] = {'posts': [op], 'last_modified': int(now), 'bumped': now}
+
+    def _reply(self, now):
+        # Recently bumped threads attract most of the replies
+        ranked = sorted(self._threads, key=lambda no: self._threads[no]['bumped'], reverse=True)
+        no = ranked[min(int(self._rng.expovariate(1 / 10)), len(ranked) - 1)]
+        thread = self._threads[no]
+        reply = self._post(now, no)
+        thread['posts'].append(reply)
+        op = thread['posts'][0]
+        op['replies'] += 1
+        op['images'] += int('tim' in reply)
+        thread['last_modified'] = int(now)
+        if op['replies'] < self.bump_limit:
+            thread['bumped'] = now
+
+    def advance(self, now=None):
+        now = time.time() if now is None else now
+        elapsed = now - self._last_advance
+        self._last_advance = now
+        self._pending_posts += self._rng.expovariate(1) * self.post_rate * elapsed
+        self._pending_threads += self._rng.expovariate(1) * self.thread_rate * elapsed
+        changed = self._pending_posts >= 1 or self._pending_threads >= 1
+        while self._pending_threads >= 1:
+            self._new_thread(now)
+            self._pending_threads -= 1
+        while self._pending_posts >= 1:
+            self._reply(now)
+            self._pending_posts -= 1
+        while len(self._threads) > self.max_threads:
+            oldest = min(self._threads, key=lambda no: self._threads[no]['bumped'])
+            thread = self._threads.pop(oldest)
+            if self.archived:
+                thread['posts'][0]['archived'] = 1
+                thread['posts'][0]['archived_on'] = int(now)
+                self._archive[oldest] = thread
+        if changed:
+            self.last_changed = now
+
+    def _ranked(self):
+        return sorted(self._threads, key=lambda no: self._threads[no]['bumped'], reverse=True)
+
+    def _pages(self, entry):
+        ranked = self._ranked()
+        return [{'page': i // THREADS_PER_PAGE + 1, 'threads': [entry(no) for no in ranked[i:i + THREADS_PER_PAGE]]} for i in range(0, len(ranked), THREADS_PER_PAGE)]
+
+    def threads_json(self):
+        return self._pages(lambda no: {'no': no, 'last_modified': self._threads[no]['last_modified'], 'replies': self._threads[no]['posts'][0]['replies']})
+
+    def catalog_json(self):
+        def entry(no):
+            thread = self._threads[no]
+            op = dict(thread['posts'][0])
+            op['last_modified'] = thread['last_modified']
+            replies = thread['posts'][1:]
+            if replies:
+                op['last_replies'] = replies[-5:]
+                op['omitted_posts'] = max(len(replies) - 5, 0)
+            return op
+        return self._pages(entry)
+
+    def archive_json(self):
+        return sorted(self._archive)
+
+    def thread(self, no):
+        thread = self._threads.get(no) or self._archive.get(no)
+        if thread is None:
+            return None, None
+        return {'posts': thread['posts']}, thread['last_modified']
+
+    def media(self, name):
+        return self._media.get(name)
+
+
+class mockapi():
+    def __init__(self, boards=5, max_threads=150, post_rate=1.0, thread_rate=0.05, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.bytes_sent = 0
+        self.statuses = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.boards = {}
+        for i in range(boards):
+            code = f'mock{i}'
+            self.boards[code] = mockboard(code, max_threads, post_rate, thread_rate, seed=None if seed is None else seed + i)
+        self._server = None
+        self._thread = None
+
+    @property
+    def posts_created(self):
+        return sum(board.posts_created for board in self.boards.values())
+
+    def boards_json(self):
+        return {'boards': [{'board': code, 'title': code, 'bump_limit': board.bump_limit, 'is_archived': int(board.archived)} for code, board in self.boards.items()]}
+
+    def respond(self, path, if_modified_since=None):
+        # Returns (status, body bytes, last_modified seconds or None, content type)
+        with self._lock:
+            self.requests += 1
+            if self._rng.random() < self.error_rate:
+                return 503, b'', None, 'text/plain'
+            parts = path.strip('/').split('/')
+            if parts == ['boards.json']:
+                return self._json(self.boards_json(), None, if_modified_since)
+            board = self.boards.get(parts[0])
+            if board is None or len(parts) < 2:
+                return 404, b'', None, 'text/plain'
+            board.advance()
+            if parts[1] == 'threads.json':
+                return self._json(board.threads_json(), board.last_changed, if_modified_since)
+            if parts[1] == 'catalog.json':
+                return self._json(board.catalog_json(), board.last_changed, if_modified_since)
+            if parts[1] == 'archive.json':
+                if not board.archived:
+                    return 404, b'', None, 'text/plain'
+                return self._json(board.archive_json(), board.last_changed, if_modified_since)
+            if parts[1] == 'thread' and len(parts) == 3 and parts[2].endswith('.json'):
+                thread, last_modified = board.thread(int(parts[2][:-len('.json')]))
+                if thread is None:
+                    return 404, b'', None, 'text/plain'
+                return self._json(thread, last_modified, if_modified_since)
+            content = board.media(parts[1])
+            if content is None:
+                return 404, b'', None, 'text/plain'
+            return 200, content, None, 'image/jpeg'
+
+    def _json(self, data, last_modified, if_modified_since):
+        if last_modified is not None and if_modified_since is not None and int(last_modified) <= if_modified_since:
+            return 304, b'', last_modified, 'application/json'
+        return 200, json.dumps(data).encode(), last_modified, 'application/json'
+
+    def _handler(self):
+        api = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                delay = api.latency + api._rng.uniform(0, api.jitter) if api.jitter else api.latency
+                if delay:
+                    time.sleep(delay)
+                since = self.headers.get('If-Modified-Since')
+                since = parsedate_to_datetime(since).timestamp() if since else None
+                status, body, last_modified, content_type = api.respond(self.path, since)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if last_modified is not None:
+                    self.send_header('Last-Modified', formatdate(last_modified, usegmt=True))
+                self.end_headers()
+                self.wfile.write(body)
+                with api._lock:
+                    api.bytes_sent += len(body)
+                    api.statuses[status] = api.statuses.get(status, 0) + 1
+
+            def log_message(self, format, *args):
+                pass
+
+        return handler
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self, host='127.0.0.1', port=0):
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mockapi', daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Serve a synthetic stand-in for the 4chan read-only API')
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--boards', type=int, default=5)
+    arg_parser.add_argument('--threads', type=int, default=150)
+    arg_parser.add_argument('--post-rate', type=float, default=1.0, help='replies per second per board')
+    arg_parser.add_argument('--thread-rate', type=float, default=0.05, help='new threads per second per board')
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    arg_parser.add_argument('--jitter', type=float, default=0.0, help='extra uniform random latency in seconds')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    arg_parser.add_argument('--seed', type=int, default=None)
+    args = arg_parser.parse_args()
+    api = mockapi(args.boards, args.threads, args.post_rate, args.thread_rate, args.latency, args.jitter, args.error_rate, args.seed)
+    print(f'Serving mock API on {api.start(args.host, args.port)}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        api.stop()
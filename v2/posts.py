@@ -0,0 +1,146 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import snapshot
+
+
+def post_digest(post):
+    return hashlib.blake2b(json.dumps(post, sort_keys=True).encode(), digest_size=8).digest()
+
+
+def _pack_refs(refs):
+    return np.asarray(refs, dtype='<i8').reshape(-1).tobytes()
+
+
+def _unpack_refs(raw):
+    return [tuple(ref) for ref in np.frombuffer(raw, dtype='<i8').reshape(-1, 2).tolist()]
+
+
+class poststore():
+    def __init__(self, dbpath, serializer='json'):
+        # Each distinct version of a post is stored once; a thread capture is an ordered list of
+        # (no, version) references, and is only written when that list changes
+        self.path = Path(dbpath)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.serializer = serializer
+        self._format = snapshot.snapshotformat('msgpack' if serializer == 'msgpack' else 'compact')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS posts (board TEXT, no INTEGER, version INTEGER, op_id INTEGER, digest BLOB, captured REAL, data BLOB, PRIMARY KEY (board, no, version))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS posts_thread ON posts (board, op_id)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS captures (board TEXT, op_id INTEGER, captured REAL, refs BLOB, PRIMARY KEY (board, op_id, captured))')
+        self._db.commit()
+        self._versions = {}
+        self._digests = {}
+        self._refs = {}
+
+    def has_thread(self, board_code, op_ID):
+        key = (board_code, int(op_ID))
+        if key in self._refs:
+            return True
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM captures WHERE board = ? AND op_id = ? LIMIT 1', key).fetchone() is not None
+
+    def _load(self, key):
+        versions = {}
+        digests = {}
+        with self._lock:
+            for no, version, digest in self._db.execute('SELECT no, version, digest FROM posts WHERE board = ? AND op_id = ? ORDER BY version', key):
+                versions[no] = (version, digest)
+                digests.setdefault(no, {})[digest] = version
+            row = self._db.execute('SELECT refs FROM captures WHERE board = ? AND op_id = ? ORDER BY captured DESC LIMIT 1', key).fetchone()
+        self._refs[key] = _unpack_refs(row[0]) if row is not None else []
+        # The last capture may reference an older version than the newest stored one
+        by_version = {(no, version): digest for no, seen in digests.items() for digest, version in seen.items()}
+        for no, version in self._refs[key]:
+            if (no, version) in by_version:
+                versions[no] = (version, by_version[(no, version)])
+        self._versions[key] = versions
+        self._digests[key] = digests
+
+    def store(self, board_code, op_ID, thread_json, complete=True, captured=None):
+        # An incomplete thread_json (e.g. from the catalog) keeps the posts of the last capture it does not mention
+        captured = time.time() if captured is None else captured
+        key = (board_code, int(op_ID))
+        if key not in self._versions:
+            self._load(key)
+        versions = self._versions[key]
+        digests = self._digests[key]
+        new_rows = []
+        mentioned = {}
+        for post in thread_json['posts']:
+            if not complete and post['no'] == key[1] and key[1] in versions:
+                post = dict(self.get_post(board_code, key[1], versions[key[1]][0]), **post)
+            digest = post_digest(post)
+            version, known = versions.get(post['no'], (0, None))
+            if digest != known:
+                # A version seen before is referenced again, so replaying older captures adds nothing
+                seen = digests.setdefault(post['no'], {})
+                version = seen.get(digest)
+                if version is None:
+                    version = seen[digest] = max(seen.values(), default=0) + 1
+                    new_rows.append((board_code, post['no'], version, key[1], digest, captured, self._format.serialize(post)))
+                versions[post['no']] = (version, digest)
+            mentioned[post['no']] = version
+        if complete:
+            refs = list(mentioned.items())
+        else:
+            refs = [(no, mentioned.pop(no, version)) for no, version in self._refs[key]] + list(mentioned.items())
+        with self._lock:
+            if new_rows:
+                self._db.executemany('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?)', new_rows)
+            if refs != self._refs[key]:
+                self._db.execute('INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?)', (board_code, key[1], captured, _pack_refs(refs)))
+            self._db.commit()
+        self._refs[key] = refs
+        return len(new_rows)
+
+    def get_post(self, board_code, no, version=None):
+        with self._lock:
+            if version is None:
+                row = self._db.execute('SELECT data FROM posts WHERE board = ? AND no = ? ORDER BY version DESC LIMIT 1', (board_code, int(no))).fetchone()
+            else:
+                row = self._db.execute('SELECT data FROM posts WHERE board = ? AND no = ? AND version = ?', (board_code, int(no), version)).fetchone()
+        return None if row is None else snapshot.deserialize(row[0])
+
+    def captures(self, board_code, op_ID):
+        with self._lock:
+            return [captured for (captured,) in self._db.execute('SELECT captured FROM captures WHERE board = ? AND op_id = ? ORDER BY captured', (board_code, int(op_ID)))]
+
+    def thread_at(self, board_code, op_ID, at=None):
+        # The thread as of its last capture at or before `at` (the latest when None), or None
+        at = float('inf') if at is None else at
+        key = (board_code, int(op_ID))
+        with self._lock:
+            row = self._db.execute('SELECT refs FROM captures WHERE board = ? AND op_id = ? AND captured <= ? ORDER BY captured DESC LIMIT 1', key + (at,)).fetchone()
+            if row is None:
+                return None
+            refs = _unpack_refs(row[0])
+            data = {}
+            for no, version, raw in self._db.execute('SELECT no, version, data FROM posts WHERE board = ? AND op_id = ?', key):
+                data[(no, version)] = raw
+        return {'posts': [snapshot.deserialize(data[ref]) for ref in refs if ref in data]}
+
+    def first_versions(self):
+        # Every post as first captured, grouped by thread and in post order
+        with self._lock:
+            rows = self._db.execute('SELECT board, op_id, data FROM posts WHERE version = 1 ORDER BY board, op_id, no').fetchall()
+        for board_code, op_ID, raw in rows:
+            yield board_code, op_ID, snapshot.deserialize(raw)
+
+    def forget(self, board_code, op_ID):
+        self._versions.pop((board_code, int(op_ID)), None)
+        self._digests.pop((board_code, int(op_ID)), None)
+        self._refs.pop((board_code, int(op_ID)), None)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
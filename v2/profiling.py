@@ -0,0 +1,201 @@
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from pathlib import Path
+from collections import Counter
+
+TRIGGER_NAME = 'profile.trigger'
+CAPTURE_MODES = ('sampling', 'cprofile')
+# From 3.12 cProfile hooks sys.monitoring, which covers the whole interpreter: the profile enabled on the
+# monitoring thread sees every thread, and enabling a second one raises ValueError
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+
+class stagetimer():
+    __slots__ = ('_profiler', '_name', '_key', '_start')
+
+    def __init__(self, profiler, name, key):
+        self._profiler = profiler
+        self._name = name
+        self._key = key
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._profiler.record(self._name, time.perf_counter() - self._start, self._key)
+
+
+class stacksampler():
+    def __init__(self, interval=0.005):
+        # Samples the stack of every thread, so fetch and writer threads show up as well as the monitor
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='stack_sampler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while self._running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f'{Path(frame.f_code.co_filename).name}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                # Numbered pool threads are folded together, e.g. fetch_job_0 and fetch_job_3
+                stack.append(names.get(ident, str(ident)).rstrip('0123456789').rstrip('_-') or 'thread')
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self, path):
+        # Writes collapsed stacks, one "frame;frame;... count" line each, as read by flamegraph tools
+        self._running = False
+        self._thread.join()
+        with open(path, 'w') as outfile:
+            for stack, count in self.stacks.most_common():
+                outfile.write(f'{stack} {count}\n')
+
+
+class stageprofiler():
+    def __init__(self, logfolder, interval=60, top=5, counters=None, logger=None):
+        # Stage times are summed over every thread that ran them, so concurrent stages can add up
+        # to more than the wall time of the iteration
+        self.logfolder = Path(logfolder)
+        self.interval = interval
+        self.top = top
+        self.path = self.logfolder / 'profile.jsonl'
+        self._counters = counters or {}
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._requested = None
+        self._capture = None
+        self._profiles = {}
+        self._reset()
+
+    def _reset(self):
+        self._started = time.time()
+        self._started_clock = time.perf_counter()
+        self._stages = {}
+        self._keys = {}
+        self._counter_start = {name: func() for name, func in self._counters.items()}
+
+    def stage(self, name, key=None):
+        return stagetimer(self, name, key)
+
+    def record(self, name, seconds, key=None):
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = [0.0, 0]
+            stage[0] += seconds
+            stage[1] += 1
+            if key is not None:
+                keys = self._keys.setdefault(name, {})
+                keys[key] = keys.get(key, 0.0) + seconds
+
+    def request(self, mode='sampling'):
+        # Captures a profile of the next iteration; safe to call from a signal handler
+        if mode not in CAPTURE_MODES:
+            raise ValueError(f'Unknown profile capture {mode}, expected sampling or cprofile')
+        self._requested = mode
+
+    def _check_trigger(self):
+        trigger = self.logfolder / TRIGGER_NAME
+        if trigger.exists():
+            mode = trigger.read_text().strip() or 'sampling'
+            trigger.unlink()
+            try:
+                self.request(mode)
+            except ValueError as error:
+                if self._logger is not None:
+                    self._logger.warning(str(error))
+
+    def wrap(self, func):
+        # Before 3.12 cProfile only sees the thread that enabled it, so during a capture each pool thread
+        # gets its own profile
+        if self._capture != 'cprofile' or not PER_THREAD_CPROFILE:
+            return func
+        def profiled(*args):
+            profile = self._profiles.get(threading.get_ident())
+            if profile is None:
+                profile = self._profiles[threading.get_ident()] = cProfile.Profile()
+            profile.enable()
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+        return profiled
+
+    def _start_capture(self):
+        self._capture, self._requested = self._requested, None
+        if self._capture == 'cprofile':
+            self._profiles = {threading.get_ident(): cProfile.Profile()}
+            try:
+                self._profiles[threading.get_ident()].enable()
+            except ValueError as error:
+                # Another profiler, e.g. python -m cProfile, already holds the hook
+                if self._logger is not None:
+                    self._logger.warning(f'Cannot start a cprofile capture ({error}), sampling instead')
+                self._profiles = {}
+                self._capture = 'sampling'
+        if self._capture == 'sampling':
+            self._sampler = stacksampler()
+        if self._logger is not None:
+            self._logger.info(f'Capturing a {self._capture} profile of the next iteration')
+
+    def _stop_capture(self):
+        stamp = time.strftime('%Y_%m_%d_%H_%M_%S')
+        if self._capture == 'cprofile':
+            self._profiles[threading.get_ident()].disable()
+            stats = pstats.Stats(*self._profiles.values())
+            path = self.logfolder / f'profile_{stamp}.prof'
+            stats.dump_stats(path)
+            self._profiles = {}
+        else:
+            path = self.logfolder / f'profile_{stamp}.folded'
+            self._sampler.stop(path)
+            self._sampler = None
+        self._capture = None
+        return path
+
+    def tick(self):
+        # Called from the monitoring loop; ends the iteration once the interval has passed
+        if time.perf_counter() - self._started_clock >= self.interval:
+            self.end_iteration()
+
+    def end_iteration(self):
+        wall = time.perf_counter() - self._started_clock
+        with self._lock:
+            stages = {name: {'seconds': round(seconds, 4), 'count': count} for name, (seconds, count) in self._stages.items()}
+            slowest = {name: [[key, round(seconds, 4)] for key, seconds in sorted(keys.items(), key=lambda item: -item[1])[:self.top]] for name, keys in self._keys.items()}
+        for name, func in self._counters.items():
+            stages[name] = {'seconds': round(func() - self._counter_start[name], 4)}
+        stages = dict(sorted(stages.items(), key=lambda item: -item[1]['seconds']))
+        idle = stages.get('idle', {'seconds': 0.0})['seconds']
+        report = {'started': self._started, 'wall': round(wall, 4), 'idle': idle, 'active': round(wall - idle, 4), 'stages': stages, 'slowest': slowest}
+        if self._capture is not None:
+            report['capture'] = str(self._stop_capture())
+        with open(self.path, 'a') as outfile:
+            outfile.write(json.dumps(report) + '\n')
+        if self._logger is not None:
+            busiest = ', '.join(f'{name} {stage["seconds"]:.2f}s' for name, stage in list(stages.items())[:4])
+            self._logger.info(f'Profile: {wall:.1f}s wall, {idle:.1f}s idle; {busiest}' + (f'; profile written to {report["capture"]}' if 'capture' in report else ''))
+        self._reset()
+        self._check_trigger()
+        if self._requested is not None:
+            self._start_capture()
+        return report
+
+    def close(self):
+        if self._capture is not None:
+            self._stop_capture()
@@ -1,31 +1,129 @@
-import json
+import os
+import signal
+import socket
+import argparse
 import datetime
 import time
 import logging
 import threading
+from concurrent.futures import wait as futures_wait, FIRST_COMPLETED
+from contextlib import nullcontext
+import multiprocessing
 from pathlib import Path
 
 from os import stat
 
-import requests
 from tqdm import tqdm
+from requests import RequestException
 
-# TODO: Run each thread concurrently with a round robin on the orginiser. 
+from fetcher import fetchengine, NOT_MODIFIED
+from index import snapshotindex
+from delta import deltastore
+from snapshot import snapshotformat
+import snapshot
+from scheduler import refreshscheduler, pollplanner, refresh_priority, DEFAULT_BUMP_LIMIT, RETRY_PRIORITY, FINAL_CAPTURE_PRIORITY, ARCHIVE_LOOKUP_PRIORITY, BOARD_POLL_PRIORITY
+from shards import shardstore, shardworker
+from checkpoint import crawlcheckpoint
+from writer import writebehind
+from retry import retryqueue, circuitbreaker, backoff_delay, DEFERRED
+from media import mediastore
+from threadtable import threadtable
+from posts import poststore, post_digest
+from events import eventstream
+from textindex import textindex
+from profiling import stageprofiler
+from logpipeline import asynclogging, threadeventsampler, THREAD_EVENT
+from metrics import metricsregistry, endpoint_for, SWEEP_BUCKETS, LAG_BUCKETS
+
+# Shared stand-in for a stage timer while profiling is off
+_NO_STAGE = nullcontext()
+
+CATALOG_ONLY_FIELDS = ('last_replies', 'omitted_posts', 'omitted_images', 'last_modified')
+# The catalog carries this many of the newest replies per thread
+CATALOG_REPLIES = 5
+# Queue key standing in for a thread number when a board's archive.json lookup is queued
+ARCHIVE_LOOKUP = 'archive'
 
 class chan4requester():
-    def __init__(self, monitor, include_boards = None, exclude_boards = None, request_time_limit = 1, stream_log_level = logging.INFO, logfolderpath = 'logs'):
-        self._base_save_path = Path().resolve()
+    def __init__(self, monitor, include_boards = None, exclude_boards = None, request_time_limit = 1, stream_log_level = logging.INFO, logfolderpath = 'logs', max_in_flight = 4, storage_mode = 'snapshot', serializer = 'json', compressor = None, min_poll_interval = 10, max_poll_interval = 600, shard_store = None, worker_id = None, checkpoint_interval = 60, refresh_mode = 'thread', writer_threads = 2, max_queued_writes = 1000, fsync_writes = False, breaker_threshold = 5, breaker_cooldown = 60, media_mode = None, media_max_bytes = None, media_request_time_limit = 1, media_workers = 2, api_url = 'https://a.4cdn.org', media_url = 'https://i.4cdn.org', savepath = None, request_observer = None, metrics_port = None, metrics_host = '127.0.0.1', async_logging = True, thread_log_sample = 1, thread_log_rate = 100, pipelined = True, event_sinks = None, text_index = False, profile = False, profile_interval = 60):
+        self._base_save_path = Path().resolve() if savepath is None else Path(savepath).resolve()
+        self._api_url = api_url
         self._save_debuglog = True
-        self._stream_log_level = logging.INFO
-        self._setup_logging(logfolderpath)
+        self._stream_log_level = stream_log_level
+        self._setup_logging(logfolderpath, async_logging, thread_log_sample, thread_log_rate)
 
         self.monitor = monitor
         self._include_boards = include_boards
         self._exclude_boards = exclude_boards
         self._request_time_limit = request_time_limit
         self._check_new_boards = True
+        self._bump_limits = {}
+        self._archived_boards = None
+        self._archives = {}
+        self._final_captures = {}
+        self._pending_deaths = {}
+        self._closed_threads = set()
+        # Digests of the newest replies per thread, to spot edits to them in the catalog
+        self._reply_digests = {}
+        self._board_listed_at = {}
+        self._poll_planner = pollplanner(min_poll_interval, max_poll_interval)
+        self._retries = retryqueue(base_delay=5 * request_time_limit)
+        self._breakers = {}
+        self._breaker_threshold = breaker_threshold
+        self._breaker_cooldown = breaker_cooldown
+
+        self._fetcher = fetchengine(request_time_limit, max_in_flight, self._logger)
+        if request_observer is not None:
+            self._fetcher.http.add_observer(request_observer)
+        if storage_mode not in ('snapshot', 'delta', 'posts'):
+            raise ValueError(f'Unknown storage mode {storage_mode}, expected snapshot, delta or posts')
+        self._storage_mode = storage_mode
+        if refresh_mode not in ('thread', 'catalog'):
+            raise ValueError(f'Unknown refresh mode {refresh_mode}, expected thread or catalog')
+        self._refresh_mode = refresh_mode
+        self._format = snapshotformat(serializer, compressor)
+        self._setup_index()
+        self._writer_blocked_seconds = 0.0
+        self._writer = writebehind(writer_threads, max_queued_writes, fsync=fsync_writes, logger=self._logger)
+        self._deltas = deltastore(self._index, self._format, self._writer)
+        self._events = None
+        if event_sinks:
+            self._events = eventstream(event_sinks, logger=self._logger)
+        self._text = None
+        if text_index:
+            self._text = textindex(self._base_save_path / 'saves' / 'text.sqlite', logger=self._logger)
+        self._posts = None
+        if storage_mode == 'posts':
+            self._posts = poststore(self._base_save_path / 'saves' / 'posts.sqlite', serializer)
+        self._media = None
+        if media_mode is not None:
+            self._media = mediastore(self._base_save_path / 'saves' / 'media', media_mode, media_max_bytes, media_request_time_limit, media_workers, media_url=media_url, logger=self._logger)
+            if request_observer is not None:
+                self._media.add_observer(request_observer)
+
+        self._shards = None
+        if shard_store is not None:
+            worker_id = f'{socket.gethostname()}-{os.getpid()}' if worker_id is None else worker_id
+            self._shards = shardworker(shardstore(shard_store), worker_id, self._logger)
+        self._checkpoint = crawlcheckpoint(self._base_save_path / 'saves', worker_id if self._shards is not None else None, checkpoint_interval)
+        self._capture_cursors = {}
+        # Cursors as last written to the checkpoint
+        self._checkpointed = {}
+        # Boards handed to another worker, with the time this worker stopped owning them
+        self._released = {}
+        self._posts_to_update = refreshscheduler()
+        self._refresh_outstanding = 0
+        self._pipelined = pipelined
+        self._in_flight = {}
+        self._requeue = {}
 
-        self.last_request = None
+        self._profiler = None
+        if profile:
+            self._setup_profiler(profile_interval)
+
+        self._metrics = None
+        if metrics_port is not None:
+            self._setup_metrics(metrics_port, metrics_host)
 
         if self.monitor is True:
             self.begin_monitoring()
@@ -35,6 +133,8 @@ class chan4requester():
         self.monitor = True
         self.monitoring_boards = []
         self.monitoring_threads = {}
+        if self._shards is not None:
+            self._shards.start()
         self._logger.debug("Initialising Monitoring Thread")
         self._monitor_thread = threading.Thread(target=self._begin_monitoring)
         self._logger.debug("Starting Thread")
@@ -45,10 +145,36 @@ class chan4requester():
         self._logger.info("Ending loop and closing monitoring thread")
         self.monitor=False
         self._monitor_thread.join()
+        self._logger.info("Flushing queued writes")
+        self._writer.flush()
+        self._save_checkpoint()
+        if self._shards is not None:
+            self._shards.stop()
         self._logger.info("Closed monitoring thread")
 
+    def run_until_stopped(self):
+        # Blocks until SIGINT or SIGTERM, then stops monitoring so queued writes, the checkpoint
+        # and shard leases are all settled before the process exits
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: stop.set())
+        while not stop.is_set() and self._monitor_thread.is_alive():
+            stop.wait(1)
+        self._logger.info('Stop requested, shutting down')
+        self.end_monitoring()
+        self.__exit__(None, None, None)
+
     def _load_old_monitors(self):
         self._update_monitoring_boards()
+        if self._shards is not None:
+            # Owned boards were loaded from the checkpoints as they were acquired
+            return
+        state = self._checkpoint.load()
+        if state is not None:
+            self._capture_cursors = state
+            self.monitoring_threads = {board: threadtable.from_dict(threads) for board, threads in state.items()}
+            self._logger.info(f'Loaded {sum(len(threads) for threads in state.values())} captured threads from checkpoint {self._checkpoint.path}')
+            return
         self._logger.debug('Checking for past captures of old threads in previous instances')
         old_monitor_dict = {}
         old_threads = 0
@@ -71,15 +197,15 @@ class chan4requester():
                 continue
             old_monitor_dict[board] = {}
 
-            with open(good_boardpath, 'r') as prev_threads_file:
-                prev_threads = json.load(prev_threads_file)
-                for page in prev_threads:
-                    for threads in page['threads']:
-                        old_monitor_dict[str(board)][str(threads['no'])] = [int(threads['last_modified']), int(threads['replies'])]
-                        old_threads += 1
+            prev_threads = snapshot.load(good_boardpath)
+            for page in prev_threads:
+                for threads in page['threads']:
+                    old_monitor_dict[str(board)][str(threads['no'])] = [int(threads['last_modified']), int(threads['replies'])]
+                    old_threads += 1
             self._logger.debug(f'{len} past captures of old threads in previous instances discovered')    
 
-        self.monitoring_threads = old_monitor_dict
+        self.monitoring_threads = {board: threadtable.from_dict(threads) for board, threads in old_monitor_dict.items()}
+        self._capture_cursors = {board: {thread: list(values) for thread, values in threads.items()} for board, threads in old_monitor_dict.items()}
         self._logger.debug(f'{old_threads} past captures of old threads in previous instances discovered')
 
     def set_include_exclude_boards(self, include_boards=False, exclude_boards=False):
@@ -94,96 +220,453 @@ class chan4requester():
     def _update_monitoring_boards(self):
         self._logger.debug('Updating monitor board list (checking)')
         if self._include_boards is not None:
-            self.monitoring_boards = self._include_boards
+            boards = self._include_boards
         elif self._exclude_boards is not None:
-            self.monitoring_boards = list(set(self._set_board_list()).difference(self._exclude_boards))
+            boards = list(set(self._set_board_list()).difference(self._exclude_boards))
+        else:
+            boards = self._set_board_list()
+        if self._shards is not None:
+            self._shards.store.register_boards(boards)
+            self._shards.renew()
+            self._sync_shard_boards()
         else:
-            self.monitoring_boards = self._set_board_list()
+            self.monitoring_boards = boards
         self._check_new_boards = False
 
+    def _sync_shard_boards(self):
+        # A board changing owner carries its crawl state over through the checkpoints and the
+        # shared index, so the new owner neither treats its threads as births nor saves them twice
+        boards = self._shards.boards
+        if boards == self.monitoring_boards:
+            return
+        released = [board for board in self.monitoring_boards if board not in boards]
+        acquired = [board for board in boards if board not in self.monitoring_boards]
+        now = time.time()
+        for board in released:
+            self._released[board] = now
+            self._pending_deaths.pop(board, None)
+            for thread in self.monitoring_threads.pop(board, threadtable()):
+                self._fetcher.http.forget(self._thread_url(board, thread))
+        if released:
+            self._save_checkpoint()
+        state = self._checkpoint.load(acquired) if acquired else None
+        state = {} if state is None else state
+        for board in acquired:
+            self._released.pop(board, None)
+            self._index.reload_board(board)
+            self._capture_cursors[board] = state.get(board, {})
+            if state.get(board):
+                self.monitoring_threads[board] = threadtable.from_dict(state[board])
+        if acquired:
+            self._logger.info(f'Took over {len(acquired)} boards with {sum(len(state.get(board, {})) for board in acquired)} captured threads from checkpoints')
+        self.monitoring_boards = boards
+
     def _begin_monitoring(self):
         self._logger.debug("_begin_monitoring entered")
         self._load_old_monitors()
         self._logger.debug("Old monitors retrieved")
+        if self._pipelined:
+            return self._run_pipeline()
         while self.monitor is True:
-            self._logger.debug("Started loop")
             if self._check_new_boards:
                 self._logger.debug("Started updating monitoring boards")
                 self._update_monitoring_boards()
+            elif self._shards is not None:
+                self._sync_shard_boards()
+            wait = min(self._poll_planner.next_due_in(self.monitoring_boards), self._retries.next_due_in())
+            if wait > 0:
+                with self._stage('idle'):
+                    time.sleep(min(wait, 1))
+                continue
+            self._logger.debug("Started loop")
             self._update_monitoring_threads()
             self._logger.debug("updating posts on monitoring list")
             self._update_posts_on_monitoring_threadlist()
+            if self._checkpoint.due():
+                self._save_checkpoint()
+            if self._profiler is not None:
+                self._profiler.end_iteration()
             self._logger.debug("Ended loop")
 
     def _update_monitoring_threads(self):
         self._logger.info('Beginning search for threads to monitor')
-        self._posts_to_update = []
+        self._posts_to_update = refreshscheduler()
         death_count = 0
         birth_count = 0
         update_count = 0
 
         # TODO: Check the comprehension here, I seem to be missing tons of threads
-        for board in self.monitoring_boards:
-            self._logger.info(f'Searching for threads in {board}')
-
-            threads_json = self.get_and_save_single_board_threadlist(board, with_return=True)
-            threads_on_board = {}
-            for page in threads_json:
-                for thread in page['threads']:
-                    threads_on_board[str(thread['no'])] = [int(thread['last_modified']), int(thread['replies'])]
-
-            if board in self.monitoring_threads:
-                for thread in self.monitoring_threads[board]:
-                    if thread in threads_on_board:
-                        pass
-                    else:
-                        self._logger.debug(f'Thread died: /{board}/{thread}')
-                        death_count +=1
-
-                for thread in threads_on_board:
-                    if thread in self.monitoring_threads[board]:
-                        if self.monitoring_threads[board][thread][0] < threads_on_board[thread][0]:
-                            self._logger.debug(f'Thread updated: /{board}/{thread}')
-                            self.monitoring_threads[board][thread] = threads_on_board[thread]
-                            self._posts_to_update.append([board, thread])
-                            update_count += 1
-                        else:
-                            self._logger.debug(f'Do not need to update thread /{board}/{thread}')
-                    else:
-                        self._logger.debug(f'New thread: /{board}/{thread}')
-                        self.monitoring_threads[board][thread] = threads_on_board[thread]
-                        self._posts_to_update.append([board, thread])
-                        birth_count += 1
-            else:
-                self._logger.debug(f'New Board: updated to monitor list {board}')
-                self.monitoring_threads[board] = threads_on_board
-                for thread in threads_on_board:
-                    self._logger.debug(f'New thread: /{board}/{thread}')
-                    self._posts_to_update.append([board, thread])
-                    birth_count += 1
+        for board in self._poll_planner.due(self.monitoring_boards):
+            sweep_start = time.perf_counter()
+            deaths, births, updates = self._sweep_board(board)
+            death_count += deaths
+            birth_count += births
+            update_count += updates
+            if self._metrics is not None:
+                self._sweep_histogram.observe(time.perf_counter() - sweep_start, board)
+        lookups = {board: self._fetcher.submit(self._job(self._lookup_archive), board) for board in list(self._pending_deaths)}
+        for board, future in lookups.items():
+            try:
+                result = future.result()
+            except Exception:
+                self._logger.exception(f'Archive lookup for /{board}/ failed')
+                result = None, None
+            self._apply_archive(board, *result)
 
         self._logger.info(f'Thread deaths in previous iteration: {death_count}')
         self._logger.info(f'Thread births in previous iteration: {birth_count}')
         self._logger.info(f'Thread updates in previous iteration: {update_count}')
         self._logger.info(f'{len(self._posts_to_update)} threads found to monitor.')
 
+    def _sweep_board(self, board):
+        listing = self._list_board(board)
+        with self._stage('board_diff', board):
+            return self._apply_board_listing(board, *listing)
+
+    def _list_board(self, board):
+        self._logger.info(f'Searching for threads in {board}')
+        listed_at = time.time()
+        with self._stage('board_poll', board):
+            return self.get_and_save_single_board_threadlist(board, with_return=True, conditional=True, catalog=self._refresh_mode == 'catalog'), listed_at
+
+    def _apply_board_listing(self, board, threads_json, listed_at):
+        death_count = 0
+        birth_count = 0
+        update_count = 0
+        if threads_json is DEFERRED:
+            retry_at = max(self._breaker(board).open_until, listed_at + self._poll_planner.interval(board))
+            self._logger.warning(f'Thread list for /{board}/ unavailable, next attempt in {retry_at - listed_at:.0f} seconds')
+            self._poll_planner.postpone(board, retry_at)
+            return 0, 0, 0
+        elapsed = listed_at - self._board_listed_at[board] if board in self._board_listed_at else None
+        self._board_listed_at[board] = listed_at
+        if threads_json is NOT_MODIFIED:
+            self._logger.debug(f'Thread list for /{board}/ not modified since last request, skipping')
+            self._poll_planner.observe(board, 0, elapsed, listed_at)
+            return 0, 0, 0
+        # Updates count once per new reply so busy threads pull the interval down
+        board_churn = 0
+        current = threadtable.from_threadlist(threads_json)
+        catalog_entries = {}
+        if self._refresh_mode == 'catalog':
+            catalog_entries = {str(thread['no']): thread for page in threads_json for thread in page['threads']}
+
+        if board in self.monitoring_threads:
+            known = self.monitoring_threads[board]
+            dead, born, updated, self.monitoring_threads[board] = known.diff(current)
+            dead = [str(thread) for thread in dead.tolist()]
+            for thread in dead:
+                self._logger.debug('Thread died: /%s/%s', board, thread, extra=THREAD_EVENT)
+                self._capture_cursors.get(board, {}).pop(thread, None)
+            death_count += len(dead)
+            board_churn += len(dead)
+            if dead:
+                self._handle_deaths(board, dead)
+
+            for thread in map(str, updated.tolist()):
+                self._logger.debug('Thread updated: /%s/%s', board, thread, extra=THREAD_EVENT)
+                previous = known[thread]
+                if not self._apply_catalog_entry(board, thread, catalog_entries.get(thread), True):
+                    self._queue_refresh(board, thread, previous, current[thread], current.page(thread), current.page_count, elapsed)
+                update_count += 1
+                board_churn += max(current[thread][1] - previous[1], 1)
+            self._logger.debug(f'{len(known) - len(dead) - len(updated)} threads on /{board}/ unchanged')
+        else:
+            self._logger.debug(f'New Board: updated to monitor list {board}')
+            self.monitoring_threads[board] = current
+            born = current.nos
+
+        for thread in map(str, born.tolist()):
+            self._logger.debug('New thread: /%s/%s', board, thread, extra=THREAD_EVENT)
+            if self._is_closed(board, thread):
+                continue
+            if not self._apply_catalog_entry(board, thread, catalog_entries.get(thread), False):
+                self._queue_refresh(board, thread, None, current[thread], current.page(thread), current.page_count, elapsed)
+            birth_count += 1
+            board_churn += 1
+
+        interval = self._poll_planner.observe(board, board_churn, elapsed, listed_at)
+        self._logger.debug(f'Next poll of /{board}/ in {interval:.0f} seconds')
+        return death_count, birth_count, update_count
+
+    def _is_closed(self, board, thread):
+        if (board, thread) in self._closed_threads or self._index.is_closed(board, thread):
+            self._logger.debug('Thread /%s/%s already closed, not monitoring', board, thread, extra=THREAD_EVENT)
+            self._closed_threads.add((board, thread))
+            return True
+        return False
+
+    def _close_thread(self, board, thread, reason):
+        self._logger.debug('Closing thread /%s/%s: %s', board, thread, reason, extra=THREAD_EVENT)
+        self._index.close_thread(board, thread, reason)
+        self._deltas.forget(board, thread)
+        self._reply_digests.pop((board, thread), None)
+        self._fetcher.http.forget(self._thread_url(board, thread))
+        if self._posts is not None:
+            self._posts.forget(board, thread)
+        if self._events is not None:
+            self._events.death(board, thread, reason)
+        if self._text is not None:
+            self._text.forget(board, thread)
+        # A final capture that 404s is closed here as missing, so _finish_capture must not close it again
+        if self._final_captures.pop((board, thread), None) is None:
+            self._closed_threads.add((board, thread))
+
+    def _handle_deaths(self, board, dead):
+        # Deaths wait for an archive.json lookup, queued like any other request, unless the board has no archive
+        listed = self._fetcher.http.last_modified(self._board_url(board, 'catalog' if self._refresh_mode == 'catalog' else 'threads'))
+        pending = self._pending_deaths.setdefault(board, {})
+        for thread in dead:
+            if (board, thread) in self._closed_threads:
+                self._closed_threads.discard((board, thread))
+            else:
+                pending[thread] = listed
+        if not pending or not self._has_archive(board):
+            self._apply_archive(board, None, None)
+
+    def _lookup_archive(self, board):
+        with self._stage('archive_lookup', board):
+            archived = self.get_board_archive(board)
+        return archived, self._fetcher.http.last_modified(self._board_url(board, 'archive'))
+
+    def _apply_archive(self, board, archived, modified):
+        # A thread missing from archive.json was pruned or deleted and would only 404, but only an archive
+        # at least as fresh as the listing that dropped the thread can say so; otherwise it gets a final fetch
+        for thread, listed in self._pending_deaths.pop(board, {}).items():
+            if (board, thread) in self._closed_threads:
+                self._closed_threads.discard((board, thread))
+            elif archived is not None and int(thread) in archived:
+                self._final_captures[(board, thread)] = 'archived'
+                self._enqueue(board, thread, FINAL_CAPTURE_PRIORITY)
+            elif archived is not None and modified is not None and listed is not None and modified >= listed:
+                self._logger.debug('Thread pruned: /%s/%s', board, thread, extra=THREAD_EVENT)
+                self._close_thread(board, thread, 'pruned')
+                self._closed_threads.discard((board, thread))
+            else:
+                self._final_captures[(board, thread)] = 'died'
+                self._enqueue(board, thread, FINAL_CAPTURE_PRIORITY)
+
+    def _apply_catalog_entry(self, board, thread, entry, known, outpath=None):
+        # Only when last_replies holds every post since our cursor; otherwise the caller queues a full fetch
+        if entry is None:
+            return False
+        if (board, thread) in self._in_flight.values():
+            # The running fetch would land after these posts and overwrite them; it is queued again instead
+            return False
+        replies = entry.get('last_replies', [])
+        op_post = {field: value for field, value in entry.items() if field not in CATALOG_ONLY_FIELDS}
+        cursor = None
+        if known:
+            cursor = self._index.get_cursor(board, thread)
+            captured = self._capture_cursors.get(board, {}).get(thread)
+            if cursor is None or captured is None:
+                return False
+            new_posts = [post for post in replies if post['no'] > cursor]
+            if captured[1] + len(new_posts) != int(entry['replies']):
+                return False
+            # A ban message or deleted file changes a post we already hold without adding a reply
+            stored = self._reply_digests.get((board, thread), {})
+            if any(stored.get(post['no']) != post_digest(post) for post in replies if post['no'] <= cursor):
+                return False
+        else:
+            new_posts = replies
+            if len(new_posts) != int(entry['replies']):
+                return False
+
+        if outpath is None:
+            outpath = self._base_save_path / 'saves' / self._get_day() / 'threads' / board
+        key = ('thread', board, int(thread))
+        path = self._index.get_thread(board, thread)
+        exists = path is not None and (path.exists() or self._writer.is_pending(key))
+        if self._storage_mode == 'posts':
+            if known and not (self._posts.has_thread(board, thread) or self._writer.is_pending(key)):
+                return False
+            path = self._posts.path
+            self._writer.submit(key, self._store_posts, board, thread, {'posts': [op_post] + new_posts}, False)
+            self._index.set_cursor(board, thread, max([int(thread) if cursor is None else cursor] + [post['no'] for post in new_posts]))
+        elif self._storage_mode == 'delta':
+            if not exists:
+                if known:
+                    return False
+                path = outpath / (thread + self._get_time() + self._format.lines_suffix)
+            self._deltas.append(board, thread, path, {'posts': [op_post] + new_posts}, complete=False)
+        else:
+            if exists and path.parent == outpath:
+                updated = self._format.path_for(path)
+                self._writer.submit(key, self._extend_snapshot, op_post, new_posts, path, updated)
+                path = updated
+            elif known:
+                return False
+            else:
+                path = outpath / (thread + self._get_time() + self._format.suffix)
+                self._writer.submit(key, self._write_snapshot, {'posts': [op_post] + new_posts}, path)
+            self._index.set_cursor(board, thread, max([int(thread) if cursor is None else cursor] + [post['no'] for post in new_posts]))
+        self._index.set_thread(board, thread, path)
+        self._capture_cursors.setdefault(board, {})[thread] = [int(entry['last_modified']), int(entry['replies'])]
+        self._remember_replies(board, thread, replies)
+        self._observe_capture_lag(board, [op_post] + new_posts, cursor)
+        if self._events is not None:
+            self._events.posts(board, thread, [op_post] + new_posts, cursor, complete=False)
+        if self._text is not None:
+            self._text.add(board, thread, [op_post] + new_posts)
+        if self._media is not None:
+            self._media.submit_posts(board, [op_post] + new_posts)
+        self._logger.debug('Applied %d posts from catalog to /%s/%s', len(new_posts), board, thread, extra=THREAD_EVENT)
+        return True
+
+    def _remember_replies(self, board, thread, replies):
+        self._reply_digests[(board, thread)] = {post['no']: post_digest(post) for post in replies[-CATALOG_REPLIES:]}
+
+    def _queue_refresh(self, board, thread, previous, current, page, page_count, elapsed):
+        if (board, thread) in self._closed_threads:
+            return
+        pending = current[1] + 1 if previous is None else max(current[1] - previous[1], 1)
+        velocity = pending / elapsed if elapsed else 0
+        bump_limit = self._bump_limits.get(board, DEFAULT_BUMP_LIMIT)
+        self._enqueue(board, thread, refresh_priority(pending, velocity, page, page_count, current[1], bump_limit))
+
+    def _enqueue(self, board, thread, priority):
+        # A thread already being fetched is queued again once that fetch completes, so it is never fetched twice at once
+        if (board, thread) in self._in_flight.values():
+            self._requeue[(board, thread)] = max(priority, self._requeue.get((board, thread), priority))
+        else:
+            self._posts_to_update.push(board, thread, priority)
+
+    def _enqueue_due_retries(self):
+        for board, post in self._retries.pop_due():
+            if post in self.monitoring_threads.get(board, {}) or (board, post) in self._final_captures:
+                self._enqueue(board, post, RETRY_PRIORITY)
+
+    def _finish_capture(self, board, post):
+        if (board, post) in self._final_captures:
+            if (board, post) not in self._retries:
+                self._close_thread(board, post, self._final_captures[(board, post)])
+        elif (board, post) not in self._retries and (board, post) not in self._closed_threads and post in self.monitoring_threads.get(board, {}):
+            self._capture_cursors.setdefault(board, {})[post] = self.monitoring_threads[board][post]
+        if self._checkpoint.due():
+            self._save_checkpoint()
+
     def _update_posts_on_monitoring_threadlist(self):
+        self._enqueue_due_retries()
         number_posts_in_iteration = len(self._posts_to_update)
+        self._refresh_outstanding = number_posts_in_iteration
         i = 1
-        prev_board = ''
-        for board, post in self._posts_to_update:
-            if prev_board != board:
-                self._logger.info(f'Updating posts in {board}')
-                prev_board = board
-            start_time = time.time()
-            self.get_and_save_thread(board, post)
-            current_time_diff = (time.time() - start_time) * (number_posts_in_iteration - i)
-            self._logger.debug(f'{i}/{number_posts_in_iteration}: Capturing post {post} in /{board}/ approximate seconds remaining in iteration {current_time_diff:n}')
+        start_time = time.time()
+        captured = self._fetcher.run_concurrently(self._job(self.get_and_save_thread), self._posts_to_update.drain(), keep_running=lambda: self.monitor)
+        for board, post in captured:
+            self._finish_capture(board, post)
+            current_time_diff = (time.time() - start_time) / i * (number_posts_in_iteration - i)
+            self._logger.debug('%d/%d: Captured post %s in /%s/ approximate seconds remaining in iteration %.0f', i, number_posts_in_iteration, post, board, current_time_diff, extra=THREAD_EVENT)
+            self._refresh_outstanding = number_posts_in_iteration - i
             i += 1
+        self._refresh_outstanding = 0
+        self._log_backpressure()
+
+    def _log_backpressure(self):
+        backpressure = self._writer.backpressure()
+        if backpressure['blocked_seconds'] - self._writer_blocked_seconds >= 0.1:
+            self._logger.warning(f'Writers falling behind: {backpressure["depth"]} writes queued, fetching blocked for {backpressure["blocked_seconds"] - self._writer_blocked_seconds:.1f} seconds this iteration')
+        else:
+            self._logger.info(f'{backpressure["depth"]} writes queued at end of iteration')
+        self._writer_blocked_seconds = backpressure['blocked_seconds']
+
+    def _run_pipeline(self):
+        # Board polls and thread fetches share one priority queue. Only max_in_flight jobs are handed
+        # to the fetcher at a time, so a fresh listing can still reprioritise everything queued behind them
+        self._logger.info('Monitoring with pipelined board polls and thread fetches')
+        while self.monitor is True or self._in_flight:
+            if self._profiler is not None:
+                self._profiler.tick()
+            if self.monitor is True:
+                if self._check_new_boards:
+                    self._update_monitoring_boards()
+                elif self._shards is not None:
+                    self._sync_shard_boards()
+                for board in self._poll_planner.due(self.monitoring_boards):
+                    if (board, None) not in self._posts_to_update and (board, None) not in self._in_flight.values():
+                        self._posts_to_update.push(board, None, BOARD_POLL_PRIORITY)
+                for board in self._pending_deaths:
+                    if (board, ARCHIVE_LOOKUP) not in self._posts_to_update and (board, ARCHIVE_LOOKUP) not in self._in_flight.values():
+                        self._posts_to_update.push(board, ARCHIVE_LOOKUP, ARCHIVE_LOOKUP_PRIORITY)
+                self._enqueue_due_retries()
+                while len(self._in_flight) < self._fetcher.max_in_flight and len(self._posts_to_update):
+                    board, thread = self._posts_to_update.pop()
+                    if board not in self.monitoring_boards:
+                        # Handed to another worker since it was queued
+                        continue
+                    if thread is None:
+                        future = self._fetcher.submit(self._job(self._list_board), board)
+                    elif thread == ARCHIVE_LOOKUP:
+                        future = self._fetcher.submit(self._job(self._lookup_archive), board)
+                    else:
+                        future = self._fetcher.submit(self._job(self.get_and_save_thread), board, thread)
+                    self._in_flight[future] = (board, thread)
+            self._refresh_outstanding = len(self._in_flight)
+
+            # Boards already queued or being polled do not shorten the wait
+            in_flight = set(self._in_flight.values())
+            waiting = [board for board in self.monitoring_boards if (board, None) not in self._posts_to_update and (board, None) not in in_flight]
+            wait = min(self._retries.next_due_in(), 1)
+            if waiting:
+                wait = min(wait, self._poll_planner.next_due_in(waiting))
+            if not self._in_flight:
+                with self._stage('idle'):
+                    time.sleep(wait)
+                continue
+            done, _ = futures_wait(list(self._in_flight), timeout=wait, return_when=FIRST_COMPLETED)
+            for future in done:
+                board, thread = self._in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    self._logger.exception(f'Job for /{board}/{thread or ""} failed')
+                    if thread == ARCHIVE_LOOKUP:
+                        # Its deaths fall back to final captures rather than waiting on another lookup
+                        self._apply_archive(board, None, None)
+                    continue
+                if thread is None:
+                    if board not in self.monitoring_boards:
+                        continue
+                    with self._stage('board_diff', board):
+                        deaths, births, updates = self._apply_board_listing(board, *result)
+                    if self._metrics is not None:
+                        self._sweep_histogram.observe(time.time() - result[1], board)
+                    if deaths or births or updates:
+                        self._logger.info(f'/{board}/: {deaths} deaths, {births} births, {updates} updates, {len(self._posts_to_update)} jobs queued')
+                elif thread == ARCHIVE_LOOKUP:
+                    if board in self.monitoring_boards:
+                        self._apply_archive(board, *result)
+                else:
+                    self._finish_capture(board, thread)
+                    if (board, thread) in self._requeue:
+                        self._posts_to_update.push(board, thread, self._requeue.pop((board, thread)))
+            if self.monitor is True and self._checkpoint.due():
+                self._save_checkpoint()
+                self._log_backpressure()
+        self._refresh_outstanding = 0
+
+    def _save_checkpoint(self):
+        # A capture whose write is still queued keeps its previous cursor, so the checkpoint never
+        # claims more than is on disk
+        with self._stage('checkpoint'):
+            state = {}
+            for board, threads in self._capture_cursors.items():
+                previous = self._checkpointed.get(board, {})
+                state[board] = {}
+                for thread, cursor in threads.items():
+                    if not self._writer.is_pending(('thread', board, int(thread))):
+                        state[board][thread] = cursor
+                    elif thread in previous:
+                        state[board][thread] = previous[thread]
+            self._checkpoint.save(state, board_saved=self._released)
+            self._checkpointed = state
+        self._logger.debug(f'Checkpointed crawl state to {self._checkpoint.path}')
 
     def _set_board_list(self):
         boards_info = self.get_chan_info_json()
         codes = [board['board'] for board in boards_info['boards']]
+        self._bump_limits = {board['board']: int(board.get('bump_limit', DEFAULT_BUMP_LIMIT)) for board in boards_info['boards']}
+        self._archived_boards = {board['board'] for board in boards_info['boards'] if board.get('is_archived')}
         return codes
 
     def _get_time(self):
@@ -198,115 +681,375 @@ class chan4requester():
         now = datetime.datetime.today()
         return now.strftime('%Y_%m_%d_%H_%M_%S')
 
-    def _check_time_and_wait(self):
-        if self.last_request is None:
-            self.last_request = time.time()
-            return
-        else:
-            if time.time() - self.last_request >= self._request_time_limit:
-                self.last_request = time.time()
-                return
-            else:
-                time.sleep(self._request_time_limit-(time.time() - self.last_request))
-                self.last_request = time.time()
-                return
-
     def get_chan_info_json(self):
-        self._check_time_and_wait()
         self._logger.debug('chan information requested')
-        r_boards = requests.get('http://a.4cdn.org/boards.json')
+        r_boards = self._fetcher.get(self._api_url + '/boards.json')
         return r_boards.json()
 
-    def get_single_board_threadlist(self, board_code):
-        self._check_time_and_wait()
-        self._logger.debug(f'Board /{board_code}/ thread information requested')
-        r_thread_list = requests.get('https://a.4cdn.org/' + board_code + '/threads.json')
-        return r_thread_list.json()
+    def _breaker(self, board_code):
+        if board_code not in self._breakers:
+            self._breakers[board_code] = circuitbreaker(self._breaker_threshold, self._breaker_cooldown)
+        return self._breakers[board_code]
+
+    def _get_from_board(self, board_code, url, conditional=False):
+        breaker = self._breaker(board_code)
+        if not breaker.allow():
+            return DEFERRED
+        try:
+            response = self._fetcher.get(url, conditional)
+        except RequestException as rerror:
+            # Counted like a 5xx, which also frees the half open probe, and retried like one
+            self._logger.warning(f'Request for {url} failed with {type(rerror).__name__}: {rerror}')
+            if breaker.record(None):
+                self._logger.warning(f'Circuit breaker for /{board_code}/ opened after a failed request, pausing requests for {breaker.open_until - time.time():.0f} seconds')
+            return DEFERRED
+        if breaker.record(response.status_code):
+            self._logger.warning(f'Circuit breaker for /{board_code}/ opened after error code {response.status_code}, pausing requests for {breaker.open_until - time.time():.0f} seconds')
+        return response
+
+    def get_single_board_threadlist(self, board_code, conditional=False, listing='threads'):
+        self._logger.debug(f'Board /{board_code}/ {listing} information requested')
+        r_thread_list = self._get_from_board(board_code, self._board_url(board_code, listing), conditional)
+        if r_thread_list is DEFERRED:
+            return DEFERRED
+        if r_thread_list.status_code == 304:
+            return NOT_MODIFIED
+        if r_thread_list.status_code != 200:
+            self._logger.warning(f'Request for {listing} on board /{board_code}/ was unsuccessful with error code {r_thread_list.status_code}')
+            return DEFERRED
+        with self._stage('json_decode'):
+            return r_thread_list.json()
+
+    def get_single_board_catalog(self, board_code, conditional=False):
+        return self.get_single_board_threadlist(board_code, conditional, listing='catalog')
+
+    def _board_url(self, board_code, name):
+        return self._api_url + '/' + board_code + '/' + name + '.json'
 
-    def get_thread(self, board_code, op_ID):
-        self._check_time_and_wait()
-        r_thread = requests.get('https://a.4cdn.org/' + board_code + '/thread/' + str(op_ID) +'.json')
+    def _thread_url(self, board_code, op_ID):
+        return self._api_url + '/' + board_code + '/thread/' + str(op_ID) + '.json'
+
+    def get_thread(self, board_code, op_ID, conditional=False, defer=False):
+        # With defer, failures are handed back as DEFERRED for the retry queue instead of retried inline
+        url = self._thread_url(board_code, op_ID)
+        r_thread = self._get_from_board(board_code, url, conditional)
         countdown = 1
-        while r_thread.status_code != 200:
-            if r_thread.status_code == 404:
-                self._logger.warning(f'Request for thread {op_ID} on board /{board_code}/ was unsuccessful with error code {r_thread.status_code}, skipping')
+        while r_thread is DEFERRED or r_thread.status_code not in (200, 304):
+            status = 'circuit breaker open' if r_thread is DEFERRED else f'error code {r_thread.status_code}'
+            if r_thread is not DEFERRED and r_thread.status_code == 404:
+                self._logger.warning(f'Request for thread {op_ID} on board /{board_code}/ was unsuccessful with {status}, skipping')
                 return None
+            elif defer:
+                self._logger.info(f'Request for thread {op_ID} on board /{board_code}/ was unsuccessful with {status}, deferring')
+                return DEFERRED
             elif countdown < 6:
-                self._logger.error(f'Request for thread {op_ID} on board /{board_code}/ was unsuccessful with error code {r_thread.status_code}, trying {countdown} more times')
+                self._logger.error(f'Request for thread {op_ID} on board /{board_code}/ was unsuccessful with {status}, trying {countdown} more times')
             else:
-                self._logger.warning(f'Request for thread {op_ID} on board /{board_code}/ was unsuccessful with error code {r_thread.status_code}, returning None')
+                self._logger.warning(f'Request for thread {op_ID} on board /{board_code}/ was unsuccessful with {status}, returning None')
                 return None
-            time.sleep(self._request_time_limit * 5)
-            r_thread = requests.get('https://a.4cdn.org/' + board_code + '/thread/' + str(op_ID) +'.json')
+            time.sleep(backoff_delay(countdown, self._request_time_limit * 5))
+            r_thread = self._get_from_board(board_code, url)
             countdown += 1
-        self._logger.debug('Recieved answer')
-        time.sleep(self._request_time_limit)
-        return r_thread.json()
+        if r_thread.status_code == 304:
+            self._logger.debug('Thread %s on board /%s/ not modified since last request', op_ID, board_code, extra=THREAD_EVENT)
+            return NOT_MODIFIED
+        self._logger.debug('Recieved answer for /%s/%s', board_code, op_ID, extra=THREAD_EVENT)
+        self._retries.succeeded(board_code, str(op_ID))
+        with self._stage('json_decode'):
+            thread_json = r_thread.json()
+        cursor = self._index.get_cursor(board_code, op_ID)
+        self._remember_replies(board_code, str(op_ID), thread_json.get('posts', [])[1:])
+        self._observe_capture_lag(board_code, thread_json.get('posts', []), cursor)
+        if self._events is not None:
+            self._events.posts(board_code, op_ID, thread_json.get('posts', []), cursor)
+        if self._text is not None:
+            self._text.add(board_code, op_ID, thread_json.get('posts', []))
+        if self._media is not None:
+            self._media.submit_posts(board_code, thread_json.get('posts', []))
+        return thread_json
+
+    def _has_archive(self, board_code):
+        if self._archived_boards is not None and board_code not in self._archived_boards:
+            return False
+        return not (board_code in self._archives and self._archives[board_code] is None)
+
+    def get_board_archive(self, board_code):
+        if not self._has_archive(board_code):
+            return None
+        r_archive = self._get_from_board(board_code, self._board_url(board_code, 'archive'), conditional=True)
+        if r_archive is DEFERRED:
+            return None
+        if r_archive.status_code == 304:
+            return self._archives.get(board_code)
+        if r_archive.status_code == 404:
+            self._logger.debug(f'Board /{board_code}/ has no archive')
+            self._archives[board_code] = None
+            return None
+        if r_archive.status_code != 200:
+            return None
+        self._archives[board_code] = set(r_archive.json())
+        return self._archives[board_code]
+
+    def _defer_thread(self, board_code, op_ID):
+        # A board outage holds the thread until the breaker lets requests through again, without using up its attempts
+        breaker = self._breaker(board_code)
+        blocked = breaker.blocked()
+        attempt = self._retries.defer(board_code, str(op_ID), not_before=breaker.open_until, count=not blocked)
+        if attempt is None:
+            self._logger.warning(f'Giving up on thread {op_ID} on board /{board_code}/ after {self._retries.max_attempts} deferred attempts')
+        elif blocked:
+            self._logger.debug('Deferred thread %s on board /%s/ while its circuit breaker is open', op_ID, board_code, extra=THREAD_EVENT)
+        else:
+            self._logger.debug('Deferred thread %s on board /%s/, attempt %d', op_ID, board_code, attempt, extra=THREAD_EVENT)
 
     def get_and_save_chan_info(self, outpath=None, filename=None):
         timestamp = self._get_day()
         if outpath is None:
             outpath = self._base_save_path / 'saves' / timestamp
         if filename is None:
-            filename = 'boards.json'
-        outpath.mkdir(parents=True, exist_ok=True)
-        with open(outpath / filename, 'w') as outfile:
-            json.dump(self.get_chan_info_json(), outfile, indent=2)
+            filename = 'boards' + self._format.suffix
+        self._writer.submit(('boards',), self._write_snapshot, self.get_chan_info_json(), outpath / filename)
 
-    def get_and_save_single_board_threadlist(self, board_code, outpath=None, filename=None, with_return=False):
+    def get_and_save_single_board_threadlist(self, board_code, outpath=None, filename=None, with_return=False, conditional=False, catalog=False):
         timestamp = self._get_day()
         if outpath is None:
             outpath = self._base_save_path / 'saves' / timestamp / 'threads_on_boards'
         if filename is None:
-            filename = board_code + self._get_time() + '.json'
-        outpath.mkdir(parents=True, exist_ok=True)
-        threadlist = self.get_single_board_threadlist(board_code)
-        for threads in outpath.iterdir():
-            if threads.name.split("_")[0] == str(board_code):
-                threads.unlink()
-        with open(outpath / filename, 'w') as outfile:
-            json.dump(threadlist, outfile, indent=2)
+            filename = board_code + self._get_time() + self._format.suffix
+        if catalog:
+            threadlist = self.get_single_board_catalog(board_code, conditional)
+        else:
+            threadlist = self.get_single_board_threadlist(board_code, conditional)
+        if threadlist is NOT_MODIFIED or threadlist is DEFERRED:
+            return threadlist if with_return else None
+        previous = self._index.get_threadlist(board_code)
+        if previous is None or previous.parent != outpath or previous == outpath / filename:
+            previous = None
+        self._index.set_threadlist(board_code, outpath / filename)
+        self._writer.submit(('threadlist', board_code), self._write_snapshot, threadlist, outpath / filename, previous)
         if with_return:
             return threadlist
 
     def get_and_save_thread(self, board_code, op_ID, outpath=None, filename=None):
+        with self._stage('thread_job', f'/{board_code}/{op_ID}'):
+            return self._get_and_save_thread(board_code, op_ID, outpath, filename)
+
+    def _get_and_save_thread(self, board_code, op_ID, outpath=None, filename=None):
         timestamp = self._get_day()
         if outpath is None:
             outpath = self._base_save_path / 'saves' / timestamp / 'threads' / board_code
-        outpath.mkdir(parents=True, exist_ok=True)
+
+        if self._storage_mode == 'delta':
+            return self._get_and_append_thread(board_code, op_ID, outpath, filename)
+        if self._storage_mode == 'posts':
+            return self._get_and_store_posts(board_code, op_ID)
 
         if filename is None:
-            filename = str(op_ID) + self._get_time() + '.json'
+            filename = str(op_ID) + self._get_time() + self._format.suffix
         fullname = outpath / filename
-        new_thread = True
-        for threads in outpath.iterdir():
-            if int(threads.name.split("_")[0]) == int(op_ID):
-                with open(threads, 'r+') as outfile:
-                    try:
-                        data = json.load(outfile)
-                    except json.decoder.JSONDecodeError as jerror:
-                        self._logger.warning(f'Loading JSON file {threads} caused error {jerror}, continuing to writing new file rather than append. Board {board_code}, post {op_ID}')
-                        continue
-                    else:
-                        to_update = self.get_thread(board_code, op_ID)
-                        if type(to_update) == type(None):
-                            self._logger.warning(f'Likely 404 caused no return for, skipping | board {board_code}, post {op_ID}')
-                            new_thread = False
-                            continue
-                        data.update(to_update)
-                        outfile.seek(0)
-                        json.dump(data, outfile, indent=2)
-                        new_thread = False
-        if new_thread is True:
-            with open(fullname, 'w') as outfile:
-                json.dump(self.get_thread(board_code, op_ID), outfile, indent=2)
+        key = ('thread', board_code, int(op_ID))
+        with self._stage('save_lookup'):
+            threads = self._index.get_thread(board_code, op_ID)
+            saved = threads is not None and threads.parent == outpath and (threads.exists() or self._writer.is_pending(key))
+        if saved:
+            to_update = self.get_thread(board_code, op_ID, conditional=True, defer=self.monitor)
+            if to_update is NOT_MODIFIED:
+                return
+            if to_update is DEFERRED:
+                self._defer_thread(board_code, op_ID)
+                return
+            if type(to_update) == type(None):
+                self._logger.warning(f'Likely 404 caused no return for, skipping | board {board_code}, post {op_ID}')
+                self._close_missing_thread(board_code, op_ID)
+                return
+            # Older snapshots are rewritten in the current format
+            updated = self._format.path_for(threads)
+            self._index.set_thread(board_code, op_ID, updated)
+            self._set_snapshot_cursor(board_code, op_ID, to_update)
+            self._writer.submit(key, self._merge_snapshot, board_code, op_ID, to_update, threads, updated, fullname)
+        else:
+            to_update = self.get_thread(board_code, op_ID, defer=self.monitor)
+            if to_update is DEFERRED:
+                self._defer_thread(board_code, op_ID)
+                return
+            if to_update is None and self.monitor:
+                self._logger.warning(f'Likely 404 caused no return for, skipping | board {board_code}, post {op_ID}')
+                self._close_missing_thread(board_code, op_ID)
+                return
+            self._index.set_thread(board_code, op_ID, fullname)
+            self._set_snapshot_cursor(board_code, op_ID, to_update)
+            self._writer.submit(key, self._write_snapshot, to_update, fullname)
+
+    def _set_snapshot_cursor(self, board_code, op_ID, thread_json):
+        if thread_json and thread_json.get('posts'):
+            cursor = self._index.get_cursor(board_code, op_ID)
+            newest = max(post['no'] for post in thread_json['posts'])
+            self._index.set_cursor(board_code, op_ID, newest if cursor is None else max(cursor, newest))
+
+    def _write_snapshot(self, data, path, previous=None):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._format.dump(data, path)
+        if previous is not None:
+            previous.unlink(missing_ok=True)
+        return [path]
+
+    def _extend_snapshot(self, op_post, new_posts, path, updated):
+        data = snapshot.load(path)
+        data['posts'][0].update(op_post)
+        captured = {post['no'] for post in data['posts']}
+        data['posts'].extend(post for post in new_posts if post['no'] not in captured)
+        return self._write_snapshot(data, updated, path if updated != path else None)
+
+    def _merge_snapshot(self, board_code, op_ID, to_update, threads, updated, fullname):
+        try:
+            data = snapshot.load(threads)
+        except (ValueError, OSError) as jerror:
+            self._logger.warning(f'Loading snapshot file {threads} caused error {jerror}, continuing to writing new file rather than append. Board {board_code}, post {op_ID}')
+            self._index.set_thread(board_code, op_ID, fullname)
+            return self._write_snapshot(to_update, fullname)
+        data.update(to_update)
+        return self._write_snapshot(data, updated, threads if updated != threads else None)
+
+    def _get_and_append_thread(self, board_code, op_ID, outpath, filename=None):
+        # Delta files are kept where the thread was first captured, across days
+        fullname = self._index.get_thread(board_code, op_ID)
+        conditional = fullname is not None and (fullname.exists() or self._writer.is_pending(('thread', board_code, int(op_ID))))
+        if not conditional:
+            if filename is None:
+                filename = str(op_ID) + self._get_time() + self._format.lines_suffix
+            fullname = outpath / filename
+        to_update = self.get_thread(board_code, op_ID, conditional=conditional, defer=self.monitor)
+        if to_update is NOT_MODIFIED:
+            return
+        if to_update is DEFERRED:
+            self._defer_thread(board_code, op_ID)
+            return
+        if to_update is None:
+            self._logger.warning(f'Likely 404 caused no return for, skipping | board {board_code}, post {op_ID}')
+            self._close_missing_thread(board_code, op_ID)
+            return
+        records = self._deltas.append(board_code, op_ID, fullname, to_update)
+        self._logger.debug('Queued %s records for /%s/%s', records, board_code, op_ID, extra=THREAD_EVENT)
+        self._index.set_thread(board_code, op_ID, fullname)
+
+    def _get_and_store_posts(self, board_code, op_ID):
+        key = ('thread', board_code, int(op_ID))
+        conditional = self._posts.has_thread(board_code, op_ID) or self._writer.is_pending(key)
+        to_update = self.get_thread(board_code, op_ID, conditional=conditional, defer=self.monitor)
+        if to_update is NOT_MODIFIED:
+            return
+        if to_update is DEFERRED:
+            self._defer_thread(board_code, op_ID)
+            return
+        if to_update is None:
+            self._logger.warning(f'Likely 404 caused no return for, skipping | board {board_code}, post {op_ID}')
+            self._close_missing_thread(board_code, op_ID)
+            return
+        self._index.set_thread(board_code, op_ID, self._posts.path)
+        self._set_snapshot_cursor(board_code, op_ID, to_update)
+        self._writer.submit(key, self._store_posts, board_code, op_ID, to_update)
+
+    def _store_posts(self, board_code, op_ID, thread_json, complete=True):
+        stored = self._posts.store(board_code, op_ID, thread_json, complete)
+        self._logger.debug('Stored %d new post versions for /%s/%s', stored, board_code, op_ID, extra=THREAD_EVENT)
+
+    def _close_missing_thread(self, board_code, op_ID):
+        # Only while monitoring, where get_thread returns None solely for a 404
+        if self.monitor:
+            self._close_thread(board_code, str(op_ID), 'missing')
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._logger.info("__exit__ called")
+        self._fetcher.close()
+        if self._media is not None:
+            self._media.close()
+        self._writer.close()
+        self._index.close()
+        if self._posts is not None:
+            self._posts.close()
+        if self._events is not None:
+            self._events.close()
+        if self._text is not None:
+            self._text.close()
+        if self._metrics is not None:
+            self._metrics.close()
+        if self._profiler is not None:
+            self._profiler.close()
+        self._logger.removeFilter(self._log_sampler)
+        if self._log_pipeline is not None:
+            self._log_pipeline.close()
+        # The logger is shared by name, so handlers are detached for the next requester in this process
+        for handler in self._log_handlers:
+            self._logger.removeHandler(handler)
+            handler.close()
+
+    def _observe_capture_lag(self, board_code, posts, cursor):
+        if self._metrics is None:
+            return
+        now = time.time()
+        for post in posts:
+            if (cursor is None or post['no'] > cursor) and 'time' in post:
+                self._lag_histogram.observe(max(now - post['time'], 0), board_code)
+
+    def _stage(self, name, key=None):
+        if self._profiler is None:
+            return _NO_STAGE
+        return self._profiler.stage(name, key)
+
+    def _job(self, func):
+        if self._profiler is None:
+            return func
+        return self._profiler.wrap(func)
+
+    def _setup_profiler(self, interval):
+        self._profiler = stageprofiler(self._logfolder, interval, counters={'rate_limit_wait': lambda: self._fetcher.rate_limiter.total_wait}, logger=self._logger)
+        self._fetcher.http.add_observer(lambda url, status, seconds, size: self._profiler.record('http', seconds))
+        self._writer.job_timer = lambda key, seconds: self._profiler.record('write', seconds)
+        # Besides the trigger file, SIGUSR1 asks for a sampled profile of the next iteration
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self._profiler.request('sampling'))
+        self._logger.info(f'Profiling to {self._profiler.path}; write sampling or cprofile to {self._logfolder / "profile.trigger"} to capture a profile')
 
-    def _setup_logging(self, logfolderpath):
+    def _setup_metrics(self, port, host):
+        self._metrics = metricsregistry()
+        request_histogram = self._metrics.histogram('request_seconds', 'API and media request latency', ('endpoint', 'board'))
+        request_counter = self._metrics.counter('requests_total', 'API and media responses by status code', ('endpoint', 'status'))
+        def observe_request(url, status, seconds, size):
+            endpoint, board = endpoint_for(url)
+            request_histogram.observe(seconds, endpoint, board)
+            request_counter.inc(endpoint, status)
+        self._fetcher.http.add_observer(observe_request)
+        if self._media is not None:
+            self._media.add_observer(observe_request)
+            self._metrics.gauge('media_queue_depth', 'Media downloads waiting for a worker', func=lambda: self._media.depth)
+            self._metrics.counter('media_rate_limiter_wait_seconds_total', 'Time media downloads spent waiting on the rate limiter', func=lambda: self._media.rate_limiter_wait)
+        self._metrics.counter('rate_limiter_wait_seconds_total', 'Time API requests spent waiting on the rate limiter', func=lambda: self._fetcher.rate_limiter.total_wait)
+        self._metrics.gauge('refresh_queue_depth', 'Thread refreshes queued or in flight this iteration', func=lambda: len(self._posts_to_update) + self._refresh_outstanding)
+        self._metrics.gauge('retry_queue_depth', 'Thread fetches deferred to the retry queue', func=lambda: len(self._retries))
+        if self._events is not None:
+            self._metrics.gauge('event_queue_depth', 'Events waiting to be sent to the event sinks', func=lambda: self._events.depth)
+            self._metrics.counter('events_dropped_total', 'Events dropped because the event queue was full', func=lambda: self._events.dropped)
+        if self._text is not None:
+            self._metrics.gauge('text_index_queue_depth', 'Captured threads waiting to be added to the text index', func=lambda: self._text.depth)
+            self._metrics.counter('text_indexed_posts_total', 'Posts added to the text index', func=lambda: self._text.indexed)
+        self._metrics.gauge('write_queue_depth', 'Snapshot writes waiting for a writer', func=lambda: self._writer.depth)
+        self._metrics.gauge('monitored_threads', 'Threads currently monitored per board', ('board',), func=lambda: {(board,): len(threads) for board, threads in list(getattr(self, 'monitoring_threads', {}).items())})
+        self._metrics.gauge('circuit_breaker_open', 'Whether the circuit breaker for a board is open', ('board',), func=lambda: {(board,): int(breaker.is_open) for board, breaker in list(self._breakers.items())})
+        self._sweep_histogram = self._metrics.histogram('board_sweep_seconds', 'Time to list a board and diff it against the monitored threads', ('board',), SWEEP_BUCKETS)
+        self._lag_histogram = self._metrics.histogram('post_capture_lag_seconds', 'Capture time minus post time for newly captured posts', ('board',), LAG_BUCKETS)
+        self._logger.info(f'Serving metrics on {self._metrics.serve(port, host)}')
+
+    def _setup_index(self):
+        savespath = self._base_save_path / 'saves'
+        self._index = snapshotindex(savespath / 'index.sqlite')
+        if self._index.is_new:
+            self._logger.info('No snapshot index found, building one from existing saves')
+            self._index.rebuild(savespath)
+
+    def _setup_logging(self, logfolderpath, async_logging=True, thread_log_sample=1, thread_log_rate=100):
         logfolder = self._base_save_path / logfolderpath
         logfolder.mkdir(parents=True, exist_ok=True)
+        self._logfolder = logfolder
 
         self._logger = logging.getLogger('4chan_requester')
         self._logger.setLevel(logging.DEBUG)
@@ -315,25 +1058,80 @@ class chan4requester():
         self._streamlogs = logging.StreamHandler()
         self._streamlogs.setLevel(self._stream_log_level)
         self._streamlogs.setFormatter(self._log_formatter)
-        self._logger.addHandler(self._streamlogs)
+        handlers = [self._streamlogs]
 
         self._infologpath = logfolder / ('info_log' + self._get_full_time() + '.log')
         self._infologfile = logging.FileHandler(self._infologpath)
         self._infologfile.setLevel(logging.INFO)
         self._infologfile.setFormatter(self._log_formatter)
-        self._logger.addHandler(self._infologfile)
+        handlers.append(self._infologfile)
 
         if self._save_debuglog:
             self._debuglogpath = logfolder / ('debug_log' + self._get_full_time() + '.log')
             self._debuglogfile = logging.FileHandler(self._debuglogpath)
             self._debuglogfile.setLevel(logging.DEBUG)
             self._debuglogfile.setFormatter(self._log_formatter)
-            self._logger.addHandler(self._debuglogfile)
+            handlers.append(self._debuglogfile)
+
+        # Per-thread debug events are sampled before they are queued or formatted
+        self._log_sampler = threadeventsampler(thread_log_sample, thread_log_rate)
+        self._logger.addFilter(self._log_sampler)
+        self._log_handlers = handlers
+        self._log_pipeline = None
+        if async_logging:
+            self._log_pipeline = asynclogging(self._logger, handlers)
+        else:
+            for handler in handlers:
+                self._logger.addHandler(handler)
 
         self._logger.debug("Logger Initalised")
 
+def _run_shard_worker(shard_store, worker_id, requester_kwargs):
+    requester_instance = chan4requester(True, shard_store=shard_store, worker_id=worker_id, logfolderpath=str(Path('logs') / worker_id), **requester_kwargs)
+    requester_instance.run_until_stopped()
+
+def run_sharded(workers, shard_store='saves/shards.sqlite', **requester_kwargs):
+    # Workers that die are restarted under the same id and pick their leases straight back up;
+    # until then their boards are reclaimed by the others once the leases expire
+    processes = {}
+    # Stopping the parent stops the workers the same way Ctrl-C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            for i in range(workers):
+                worker_id = f'{socket.gethostname()}-worker{i}'
+                if worker_id not in processes or not processes[worker_id].is_alive():
+                    worker_kwargs = dict(requester_kwargs)
+                    # Workers share this host's IP, so they split one request budget between them
+                    worker_kwargs['request_time_limit'] = requester_kwargs.get('request_time_limit', 1) * workers
+                    if worker_kwargs.get('metrics_port') is not None:
+                        # Each worker serves its own metrics on consecutive ports
+                        worker_kwargs['metrics_port'] += i
+                    processes[worker_id] = multiprocessing.Process(target=_run_shard_worker, args=(shard_store, worker_id, worker_kwargs), name=worker_id)
+                    processes[worker_id].start()
+            time.sleep(5)
+    except KeyboardInterrupt:
+        # Each worker flushes its writes, checkpoints and releases its leases on SIGTERM
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
 if __name__ == "__main__":
-    requester_instance = chan4requester(True)
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--workers', type=int, default=1)
+    arg_parser.add_argument('--shard-store', default=None)
+    arg_parser.add_argument('--worker-id', default=None)
+    arg_parser.add_argument('--metrics-port', type=int, default=None)
+    arg_parser.add_argument('--profile', action='store_true', help='write per-stage timings to logs/profile.jsonl')
+    arg_parser.add_argument('--text-index', action='store_true', help='index post text into saves/text.sqlite as posts are captured')
+    arg_parser.add_argument('--events', action='append', default=None, help='event sink: stdout, unix:<path>, tcp:<host>:<port> or log:<folder>; repeatable')
+    args = arg_parser.parse_args()
+    if args.workers > 1:
+        run_sharded(args.workers, args.shard_store or 'saves/shards.sqlite', metrics_port=args.metrics_port, event_sinks=args.events, text_index=args.text_index, profile=args.profile)
+    else:
+        requester_instance = chan4requester(True, shard_store=args.shard_store, worker_id=args.worker_id, metrics_port=args.metrics_port, event_sinks=args.events, text_index=args.text_index, profile=args.profile)
+        requester_instance.run_until_stopped()
 
 # requester_instance = chan4requester(False)
 # requester_instance.get_and_save_chan_info()
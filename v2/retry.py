@@ -0,0 +1,124 @@
+import time
+import heapq
+import random
+import threading
+
+DEFERRED = object()
+
+
+def backoff_delay(attempt, base, cap=300):
+    # Exponential backoff with jitter so retries from one sweep do not arrive together
+    delay = min(base * 2 ** (attempt - 1), cap)
+    return random.uniform(delay / 2, delay)
+
+
+def is_breaker_failure(status_code):
+    # None stands for a request that raised before any response arrived
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+class circuitbreaker():
+    def __init__(self, failure_threshold=5, cooldown=60, max_cooldown=900):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+        self._current_cooldown = cooldown
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.open_until > 0
+
+    def allow(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self.is_open:
+                return True
+            if now < self.open_until or self._probing:
+                return False
+            # Half open: let a single probe through to test the board
+            self._probing = True
+            return True
+
+    def blocked(self, now=None):
+        # Whether allow() would refuse right now, without taking the half open probe
+        now = time.time() if now is None else now
+        with self._lock:
+            return self.is_open and (now < self.open_until or self._probing)
+
+    def record(self, status_code, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if not is_breaker_failure(status_code):
+                self.failures = 0
+                self.open_until = 0.0
+                self._probing = False
+                self._current_cooldown = self.cooldown
+                return False
+            self.failures += 1
+            if self._probing:
+                self._current_cooldown = min(self._current_cooldown * 2, self.max_cooldown)
+            if self._probing or self.failures >= self.failure_threshold:
+                self.open_until = now + self._current_cooldown
+                self._probing = False
+                self.trips += 1
+                return True
+            return False
+
+
+class retryqueue():
+    def __init__(self, base_delay=5, max_attempts=5, max_delay=300):
+        self.base_delay = base_delay
+        self.max_attempts = max_attempts
+        self.max_delay = max_delay
+        self._heap = []
+        self._attempts = {}
+        self._scheduled = set()
+        self._lock = threading.Lock()
+
+    def defer(self, board_code, op_ID, not_before=None, now=None, count=True):
+        # Uncounted deferrals, e.g. while the board's breaker is open, wait without using up attempts
+        now = time.time() if now is None else now
+        key = (board_code, op_ID)
+        with self._lock:
+            attempt = self._attempts.get(key, 0) + int(count)
+            if attempt > self.max_attempts:
+                self._attempts.pop(key, None)
+                return None
+            if count:
+                self._attempts[key] = attempt
+            due = now + backoff_delay(max(attempt, 1), self.base_delay, self.max_delay)
+            if not_before is not None:
+                due = max(due, not_before)
+            if key not in self._scheduled:
+                self._scheduled.add(key)
+                heapq.heappush(self._heap, (due, key))
+            return attempt
+
+    def succeeded(self, board_code, op_ID):
+        self._attempts.pop((board_code, op_ID), None)
+
+    def pop_due(self, now=None):
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, key = heapq.heappop(self._heap)
+                self._scheduled.discard(key)
+                due.append(key)
+        return due
+
+    def next_due_in(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            return max(self._heap[0][0] - now, 0) if self._heap else float('inf')
+
+    def __contains__(self, key):
+        return key in self._scheduled
+
+    def __len__(self):
+        return len(self._scheduled)
@@ -0,0 +1,90 @@
+import time
+import heapq
+import itertools
+
+DEFAULT_BUMP_LIMIT = 300
+RISK_WEIGHT = 4
+VELOCITY_WEIGHT = 60
+RETRY_PRIORITY = 1e6
+FINAL_CAPTURE_PRIORITY = 2e6
+ARCHIVE_LOOKUP_PRIORITY = 2.5e6
+BOARD_POLL_PRIORITY = 3e6
+
+
+def refresh_priority(pending, velocity, page, page_count, replies, bump_limit):
+    # Expected posts at stake, scaled up the closer the thread is to being pruned
+    page_risk = page / page_count if page_count else 0
+    bump_risk = min(replies / bump_limit, 1) if bump_limit else 0
+    risk = max(page_risk, bump_risk)
+    return pending * (1 + RISK_WEIGHT * risk) + VELOCITY_WEIGHT * velocity
+
+
+class refreshscheduler():
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def push(self, board_code, op_ID, priority):
+        key = (board_code, op_ID)
+        if key in self._entries:
+            self._entries[key][-1] = None
+        entry = [-priority, next(self._counter), key]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def pop(self):
+        while self._heap:
+            _, _, key = heapq.heappop(self._heap)
+            if key is not None:
+                del self._entries[key]
+                return key
+        raise IndexError('pop from an empty refreshscheduler')
+
+    def drain(self):
+        while self._entries:
+            yield self.pop()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class pollplanner():
+    def __init__(self, min_interval=10, max_interval=600, target_changes=5, smoothing=0.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_changes = target_changes
+        self.smoothing = smoothing
+        self._intervals = {}
+        self._next_poll = {}
+
+    def interval(self, board_code):
+        return self._intervals.get(board_code, self.min_interval)
+
+    def due(self, boards, now=None):
+        now = time.time() if now is None else now
+        return [board for board in boards if self._next_poll.get(board, 0) <= now]
+
+    def next_due_in(self, boards, now=None):
+        # With no boards nothing is ever due, so callers fall back to their idle sleep
+        now = time.time() if now is None else now
+        return max(min((self._next_poll.get(board, 0) for board in boards), default=float('inf')) - now, 0)
+
+    def postpone(self, board_code, until):
+        self._next_poll[board_code] = max(self._next_poll.get(board_code, 0), until)
+
+    def observe(self, board_code, changes, elapsed, now=None):
+        # Aim for roughly target_changes births, deaths and updates per poll
+        now = time.time() if now is None else now
+        current = self.interval(board_code)
+        if elapsed:
+            rate = changes / elapsed
+            ideal = self.target_changes / rate if rate else current * 2
+            current = self.smoothing * current + (1 - self.smoothing) * ideal
+        current = min(max(current, self.min_interval), self.max_interval)
+        self._intervals[board_code] = current
+        self._next_poll[board_code] = now + current
+        return current
@@ -0,0 +1,97 @@
+import math
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+
+class shardstore():
+    def __init__(self, dbpath, lease_seconds=60):
+        dbpath = Path(dbpath)
+        dbpath.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(dbpath, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS shards (board TEXT PRIMARY KEY, worker TEXT, lease_until REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, heartbeat REAL)')
+
+    def register_boards(self, boards):
+        with self._lock:
+            self._db.executemany('INSERT OR IGNORE INTO shards VALUES (?, NULL, 0)', [(board,) for board in boards])
+
+    def renew(self, worker_id):
+        # One write transaction per heartbeat so claims from different workers never interleave
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (worker_id, now))
+                live = self._db.execute('SELECT COUNT(*) FROM workers WHERE heartbeat > ?', (now - self.lease_seconds,)).fetchone()[0]
+                total = self._db.execute('SELECT COUNT(*) FROM shards').fetchone()[0]
+                share = math.ceil(total / max(live, 1))
+
+                self._db.execute('UPDATE shards SET lease_until = ? WHERE worker = ?', (now + self.lease_seconds, worker_id))
+                owned = [row[0] for row in self._db.execute('SELECT board FROM shards WHERE worker = ? ORDER BY board', (worker_id,))]
+                if len(owned) > share:
+                    self._db.executemany('UPDATE shards SET worker = NULL, lease_until = 0 WHERE board = ?', [(board,) for board in owned[share:]])
+                    owned = owned[:share]
+                elif len(owned) < share:
+                    free = [row[0] for row in self._db.execute('SELECT board FROM shards WHERE worker IS NULL OR lease_until < ? ORDER BY board LIMIT ?', (now, share - len(owned)))]
+                    self._db.executemany('UPDATE shards SET worker = ?, lease_until = ? WHERE board = ?', [(worker_id, now + self.lease_seconds, board) for board in free])
+                    owned += free
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return sorted(owned)
+
+    def release(self, worker_id):
+        with self._lock:
+            self._db.execute('UPDATE shards SET worker = NULL, lease_until = 0 WHERE worker = ?', (worker_id,))
+            self._db.execute('DELETE FROM workers WHERE worker = ?', (worker_id,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class shardworker():
+    def __init__(self, store, worker_id, logger):
+        self.store = store
+        self.worker_id = worker_id
+        self.boards = []
+        self._logger = logger
+        self._running = False
+        self._thread = None
+
+    def renew(self):
+        boards = self.store.renew(self.worker_id)
+        if boards != self.boards:
+            self._logger.info(f'Worker {self.worker_id} now owns {len(boards)} boards: {boards}')
+        self.boards = boards
+        return boards
+
+    def _heartbeat(self):
+        interval = self.store.lease_seconds / 3
+        next_renewal = time.time() + interval
+        while self._running:
+            if time.time() >= next_renewal:
+                try:
+                    self.renew()
+                except sqlite3.Error as serror:
+                    self._logger.error(f'Worker {self.worker_id} failed to renew shard leases: {serror}')
+                next_renewal = time.time() + interval
+            time.sleep(1)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._heartbeat, name=f'shard_{self.worker_id}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self.store.release(self.worker_id)
+        self.boards = []
@@ -0,0 +1,118 @@
+import io
+import os
+import gzip
+import json
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+SERIALIZERS = ('json', 'compact', 'msgpack')
+COMPRESSORS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class snapshotformat():
+    def __init__(self, serializer='json', compressor=None, level=None):
+        if serializer not in SERIALIZERS:
+            raise ValueError(f'Unknown serializer {serializer}, expected one of {SERIALIZERS}')
+        if compressor not in COMPRESSORS:
+            raise ValueError(f'Unknown compressor {compressor}, expected one of {tuple(COMPRESSORS)}')
+        if serializer == 'msgpack' and msgpack is None:
+            raise ImportError('msgpack serializer requested but msgpack is not installed')
+        if compressor == 'zstd' and zstandard is None:
+            raise ImportError('zstd compressor requested but zstandard is not installed')
+        self.serializer = serializer
+        self.compressor = compressor
+        self.level = level
+
+    @property
+    def suffix(self):
+        return ('.msgpack' if self.serializer == 'msgpack' else '.json') + COMPRESSORS[self.compressor]
+
+    @property
+    def lines_suffix(self):
+        # Delta logs are always JSON lines so they can be appended to
+        return '.jsonl' + COMPRESSORS[self.compressor]
+
+    def serialize(self, data):
+        if self.serializer == 'msgpack':
+            return msgpack.packb(data)
+        if self.serializer == 'compact':
+            return json.dumps(data, separators=(',', ':')).encode()
+        return json.dumps(data, indent=2).encode()
+
+    def compress(self, raw):
+        if self.compressor == 'gzip':
+            return gzip.compress(raw, compresslevel=self.level or 6)
+        if self.compressor == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level or 3).compress(raw)
+        return raw
+
+    def dumps(self, data):
+        return self.compress(self.serialize(data))
+
+    def dump(self, data, path):
+        # Written to a sibling file and renamed so readers never see a partial snapshot
+        path = Path(path)
+        tmppath = path.with_name(path.name + '.tmp')
+        with open(tmppath, 'wb') as outfile:
+            outfile.write(self.dumps(data))
+        os.replace(tmppath, path)
+
+    def append_lines(self, records, path):
+        raw = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records).encode()
+        with open(path, 'ab') as outfile:
+            outfile.write(self.compress(raw))
+
+    def path_for(self, path, lines=False):
+        path = Path(path)
+        return path.with_name(path.name.split('.')[0] + (self.lines_suffix if lines else self.suffix))
+
+
+def decompress(raw):
+    if raw[:2] == GZIP_MAGIC:
+        return gzip.decompress(raw)
+    if raw[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImportError('zstd compressed snapshot found but zstandard is not installed')
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(raw), read_across_frames=True)
+        return reader.read()
+    return raw
+
+
+def deserialize(raw):
+    if raw.lstrip()[:1] in (b'{', b'[', b'n'):
+        return json.loads(raw)
+    if msgpack is None:
+        raise ImportError('msgpack encoded snapshot found but msgpack is not installed')
+    return msgpack.unpackb(raw, strict_map_key=False)
+
+
+def is_lines(path):
+    return '.jsonl' in Path(path).suffixes
+
+
+def load(path):
+    with open(path, 'rb') as infile:
+        raw = decompress(infile.read())
+    if is_lines(path):
+        return [json.loads(line) for line in raw.splitlines() if line.strip()]
+    return deserialize(raw)
+
+
+def iter_lines(path):
+    with open(path, 'rb') as infile:
+        raw = decompress(infile.read())
+    for line in raw.splitlines():
+        if line.strip():
+            yield json.loads(line)
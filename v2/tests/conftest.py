@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The v2 modules import each other by bare name, as when run from the v2 folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
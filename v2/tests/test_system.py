@@ -0,0 +1,85 @@
+import time
+import logging
+
+import pytest
+
+import snapshot
+import benchmark
+from mockapi import mockapi
+from requester import chan4requester
+
+
+@pytest.fixture
+def api():
+    api = mockapi(2, 20, 2.0, 0.2, seed=1)
+    api.start()
+    yield api
+    api.stop()
+
+
+def _run_requester(api, savepath, seconds=4, **kwargs):
+    requester_instance = chan4requester(False, api_url=api.url, media_url=api.url, savepath=savepath, request_time_limit=0.01, media_request_time_limit=0.01,
+                                        min_poll_interval=1, max_poll_interval=2, stream_log_level=logging.WARNING, **kwargs)
+    requester_instance.begin_monitoring()
+    try:
+        time.sleep(seconds)
+    finally:
+        requester_instance.end_monitoring()
+        requester_instance.__exit__(None, None, None)
+
+
+def test_snapshots_match_the_api(api, tmp_path):
+    _run_requester(api, tmp_path)
+    saves = [path for path in (tmp_path / 'saves').glob('*/threads/*/*') if not path.name.endswith('.tmp')]
+    assert saves
+    for path in saves:
+        thread = snapshot.load(path)
+        op = thread['posts'][0]
+        live, _ = api.boards[path.parent.name].thread(op['no'])
+        # A snapshot holds a prefix of the thread as the API serves it now; only the OP's counters move on
+        captured = len(thread['posts'])
+        assert [post['no'] for post in thread['posts']] == [post['no'] for post in live['posts'][:captured]]
+        assert thread['posts'][1:] == live['posts'][1:captured]
+
+
+@pytest.mark.parametrize('storage_mode', ['snapshot', 'delta', 'posts'])
+def test_storage_modes_capture_posts(storage_mode):
+    result = benchmark.run(duration=3, boards=2, threads=20, storage_mode=storage_mode)
+    assert result['posts_captured'] > 0
+    assert result['posts_captured'] <= result['posts_created']
+    assert result['requests'] > 0
+
+
+def test_catalog_refresh_captures_every_thread():
+    result = benchmark.run(duration=3, boards=2, threads=20, thread_rate=0.0, refresh_mode='catalog')
+    assert result['threads_captured'] == 40
+
+
+def test_media_downloads_keep_up(api, tmp_path):
+    _run_requester(api, tmp_path, media_mode='full')
+    media = [path for path in (tmp_path / 'saves' / 'media').rglob('*') if path.is_file()]
+    expected = {post['md5'] for board in api.boards.values() for thread in board._threads.values() for post in thread['posts'] if 'md5' in post}
+    # With a one second media budget only a handful would be stored in this time
+    assert len(media) >= len(expected) // 2
+
+
+def test_requester_releases_its_log_handlers(api, tmp_path):
+    logger = logging.getLogger('4chan_requester')
+    before = list(logger.handlers)
+    _run_requester(api, tmp_path / 'first', seconds=1)
+    _run_requester(api, tmp_path / 'second', seconds=1, async_logging=False)
+    assert logger.handlers == before
+
+
+def test_benchmark_reports_requester_rss():
+    result = benchmark.run(duration=2, boards=1, threads=10)
+    assert result['peak_rss'] > 0
+    assert result['duration'] >= 2
+    assert sum(result['statuses'].values()) == result['requests']
+
+
+def test_compare_flags_regressions():
+    baseline = {'posts_per_second': 100, 'latency_p99': 0.1}
+    assert benchmark.compare({'posts_per_second': 95, 'latency_p99': 0.1, 'threads_per_second': 1, 'requests_per_post': 1, 'latency_p50': 0, 'bytes_written': 0, 'peak_rss': 0}, baseline) == []
+    regressions = benchmark.compare({'posts_per_second': 50, 'latency_p99': 0.2, 'threads_per_second': 1, 'requests_per_post': 1, 'latency_p50': 0, 'bytes_written': 0, 'peak_rss': 0}, baseline)
+    assert len(regressions) == 2
@@ -0,0 +1,321 @@
+import re
+import sys
+import html
+import time
+import zlib
+import queue
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+
+import numpy as np
+
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+# Once a term has more than MAX_BLOCKS blocks its newest ones are merged, taking in each older block
+# that is at most MERGE_RATIO times larger, so every posting is rewritten a logarithmic number of times
+MAX_BLOCKS = 8
+MERGE_RATIO = 2
+
+_TAG = re.compile(r'<[^>]*>')
+_TOKEN = re.compile(r'\w+')
+_DURATION = re.compile(r'^(\d+(?:\.\d+)?)([smhdw])$')
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def tokenize(text):
+    # <wbr> splits long words in 4chan's markup, every other tag separates words
+    text = _TAG.sub(' ', text.replace('<wbr>', ''))
+    return [term for term in _TOKEN.findall(html.unescape(text).lower()) if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH]
+
+
+def post_terms(post):
+    return set(tokenize(post.get('sub', '') + ' ' + post.get('com', '')))
+
+
+def _encode_block(docids, times, tids):
+    # Doc ids and times are delta coded, so the zlib pass mostly sees small numbers
+    columns = np.concatenate([np.diff(docids, prepend=0), np.diff(times, prepend=0), tids])
+    return zlib.compress(columns.astype('<i8').tobytes(), 1)
+
+
+def _encode_blocks(term_ids, docids, times, tids):
+    # One pass over a whole flush: entries are grouped by term, and each term's columns are
+    # laid out contiguously as they are in _encode_block
+    order = np.argsort(term_ids, kind='stable')
+    term_ids, docids, times, tids = term_ids[order], docids[order], times[order], tids[order]
+    starts = np.flatnonzero(np.diff(term_ids, prepend=-1))
+    counts = np.diff(np.append(starts, len(term_ids)))
+    doc_deltas = np.diff(docids, prepend=0)
+    time_deltas = np.diff(times, prepend=0)
+    doc_deltas[starts] = docids[starts]
+    time_deltas[starts] = times[starts]
+    start = np.repeat(starts, counts)
+    count = np.repeat(counts, counts)
+    position = np.arange(len(term_ids)) - start
+    columns = np.empty(3 * len(term_ids), dtype='<i8')
+    columns[3 * start + position] = doc_deltas
+    columns[3 * start + count + position] = time_deltas
+    columns[3 * start + 2 * count + position] = tids
+    raw = columns.tobytes()
+    return [(int(term_ids[first]), int(n), zlib.compress(raw[24 * first:24 * (first + n)], 1)) for first, n in zip(starts.tolist(), counts.tolist())]
+
+
+def _decode_block(raw, count):
+    columns = np.frombuffer(zlib.decompress(raw), dtype='<i8').reshape(3, count)
+    return np.cumsum(columns[0]), np.cumsum(columns[1]), columns[2].copy()
+
+
+def parse_time(value):
+    # An absolute unix time, or a duration before now such as 90m, 12h or 7d
+    if value is None:
+        return None
+    match = _DURATION.match(str(value))
+    if match is not None:
+        return time.time() - float(match.group(1)) * _UNITS[match.group(2)]
+    return float(value)
+
+
+class textindex():
+    def __init__(self, dbpath, flush_posts=5000, flush_interval=10, max_queued=1000, logger=None):
+        # Posts are indexed once, in the order they arrive; each flush appends one block of
+        # (doc id, post time, thread id) postings per term it saw
+        self.path = Path(dbpath)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_posts = flush_posts
+        self.flush_interval = flush_interval
+        self.indexed = 0
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS threads (tid INTEGER PRIMARY KEY, board TEXT, op_id INTEGER, UNIQUE (board, op_id))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, tid INTEGER, no INTEGER, time INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS docs_thread ON docs (tid, no)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS postings (term TEXT, block INTEGER, count INTEGER, data BLOB, PRIMARY KEY (term, block)) WITHOUT ROWID')
+        self._db.execute('CREATE TABLE IF NOT EXISTS flushes (block INTEGER PRIMARY KEY, flushed REAL, docs INTEGER)')
+        self._tids = {}
+        self._last_no = {}
+        # Blocks per term as last seen by this process; a stale count only moves a merge earlier or later
+        self._block_counts = {}
+        self._pending = []
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = None
+
+    def add(self, board_code, op_ID, posts):
+        # Called from the fetch threads; tokenizing and writing happen on the indexing thread
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='text_index', daemon=True)
+                    self._thread.start()
+        self._queue.put(('add', board_code, int(op_ID), posts))
+
+    def forget(self, board_code, op_ID):
+        if self._thread is not None:
+            self._queue.put(('forget', board_code, int(op_ID), None))
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                job = self._queue.get(timeout=max(last_flush + self.flush_interval - time.monotonic(), 0.01))
+            except queue.Empty:
+                job = None
+            if job is not None:
+                action, board_code, op_ID, posts = job
+                if action == 'stop':
+                    self._flush()
+                    self._queue.task_done()
+                    return
+                if action == 'add':
+                    self._collect(board_code, op_ID, posts)
+                elif action == 'flush':
+                    self._flush()
+                else:
+                    self._last_no.pop(self._tids.pop((board_code, op_ID), None), None)
+                self._queue.task_done()
+            if len(self._pending) >= self.flush_posts or (self._pending and time.monotonic() - last_flush >= self.flush_interval):
+                self._flush()
+                last_flush = time.monotonic()
+            elif not self._pending:
+                last_flush = time.monotonic()
+
+    def _thread_id(self, board_code, op_ID):
+        key = (board_code, op_ID)
+        if key not in self._tids:
+            with self._lock:
+                self._db.execute('INSERT OR IGNORE INTO threads (board, op_id) VALUES (?, ?)', key)
+                tid = self._db.execute('SELECT tid FROM threads WHERE board = ? AND op_id = ?', key).fetchone()[0]
+                last_no = self._db.execute('SELECT max(no) FROM docs WHERE tid = ?', (tid,)).fetchone()[0]
+            self._tids[key] = tid
+            self._last_no[tid] = last_no or 0
+        return self._tids[key]
+
+    def _collect(self, board_code, op_ID, posts):
+        tid = self._thread_id(board_code, op_ID)
+        last_no = self._last_no[tid]
+        for post in posts:
+            if post['no'] > last_no:
+                self._pending.append((tid, post['no'], int(post.get('time', 0)), post_terms(post)))
+                last_no = post['no']
+        self._last_no[tid] = last_no
+
+    def _flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        started = time.monotonic()
+        with self._lock:
+            # Doc ids and block numbers are taken inside the write transaction, so workers sharing
+            # the file keep both increasing in commit order
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                first_id = (self._db.execute('SELECT max(id) FROM docs').fetchone()[0] or 0) + 1
+                block = self._db.execute('INSERT INTO flushes (flushed, docs) VALUES (?, ?)', (time.time(), len(pending))).lastrowid
+                self._db.executemany('INSERT INTO docs VALUES (?, ?, ?, ?)', ((first_id + i, tid, no, posted) for i, (tid, no, posted, _) in enumerate(pending)))
+                postings = {}
+                entries = []
+                for i, (tid, _, posted, terms) in enumerate(pending):
+                    for term in terms:
+                        entries.append((postings.setdefault(term, len(postings)), first_id + i, posted, tid))
+                terms = list(postings)
+                rows = [(terms[term_id], block, count, data) for term_id, count, data in _encode_blocks(*np.array(entries, dtype=np.int64).reshape(-1, 4).T)]
+                self._db.executemany('INSERT INTO postings VALUES (?, ?, ?, ?)', rows)
+                merged = 0
+                for term in terms:
+                    self._block_counts[term] = self._block_counts.get(term, 0) + 1
+                    if self._block_counts[term] > MAX_BLOCKS:
+                        merged += self._merge(term)
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        self.indexed += len(pending)
+        if self._logger is not None:
+            self._logger.debug(f'Indexed {len(pending)} posts under {len(postings)} terms in {time.monotonic() - started:.2f} seconds, {merged} blocks merged')
+
+    def _merge(self, term):
+        blocks = self._db.execute('SELECT block, count FROM postings WHERE term = ? ORDER BY block', (term,)).fetchall()
+        merge_from = len(blocks) - 1
+        total = blocks[-1][1]
+        while merge_from > 0 and (merge_from == len(blocks) - 1 or blocks[merge_from - 1][1] <= total * MERGE_RATIO):
+            merge_from -= 1
+            total += blocks[merge_from][1]
+        self._block_counts[term] = merge_from + 1
+        if merge_from == len(blocks) - 1:
+            return 0
+        merging = blocks[merge_from:]
+        columns = [[], [], []]
+        for raw, count in self._db.execute('SELECT data, count FROM postings WHERE term = ? AND block >= ? ORDER BY block', (term, merging[0][0])):
+            for column, values in zip(columns, _decode_block(raw, count)):
+                column.append(values)
+        self._db.execute('DELETE FROM postings WHERE term = ? AND block >= ?', (term, merging[0][0]))
+        self._db.execute('INSERT INTO postings VALUES (?, ?, ?, ?)', (term, merging[0][0], total, _encode_block(*(np.concatenate(column) for column in columns))))
+        return len(merging) - 1
+
+    def _postings(self, term):
+        with self._lock:
+            rows = self._db.execute('SELECT data, count FROM postings WHERE term = ? ORDER BY block', (term,)).fetchall()
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        columns = list(zip(*(_decode_block(raw, count) for raw, count in rows)))
+        return tuple(np.concatenate(column) for column in columns)
+
+    def _match(self, query, board=None, since=None, until=None):
+        # Posts containing every term of the query, as (doc ids, times, thread ids)
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        lists = sorted((self._postings(term) for term in terms), key=lambda columns: len(columns[0]))
+        docids, times, tids = lists[0]
+        for other in lists[1:]:
+            if not len(docids):
+                break
+            docids, keep, _ = np.intersect1d(docids, other[0], assume_unique=True, return_indices=True)
+            times, tids = times[keep], tids[keep]
+        mask = np.ones(len(docids), dtype=bool)
+        if since is not None:
+            mask &= times >= parse_time(since)
+        if until is not None:
+            mask &= times <= parse_time(until)
+        if board is not None:
+            with self._lock:
+                board_tids = [tid for (tid,) in self._db.execute('SELECT tid FROM threads WHERE board = ?', (board,))]
+            mask &= np.isin(tids, board_tids)
+        return docids[mask], times[mask], tids[mask]
+
+    def _threads_for(self, tids):
+        with self._lock:
+            rows = self._db.execute(f'SELECT tid, board, op_id FROM threads WHERE tid IN ({",".join("?" * len(tids))})', tids).fetchall()
+        return {tid: (board, op_id) for tid, board, op_id in rows}
+
+    def search(self, query, board=None, since=None, until=None, limit=50):
+        # Newest matching posts first, as dicts of board, thread, no and time
+        docids, times, tids = self._match(query, board, since, until)
+        order = np.argsort(-times, kind='stable')[:limit]
+        docids = docids[order].tolist()
+        if not docids:
+            return []
+        with self._lock:
+            nos = dict(self._db.execute(f'SELECT id, no FROM docs WHERE id IN ({",".join("?" * len(docids))})', docids).fetchall())
+        threads = self._threads_for(sorted(set(tids[order].tolist())))
+        return [{'board': threads[tid][0], 'thread': threads[tid][1], 'no': nos[docid], 'time': posted} for docid, posted, tid in zip(docids, times[order].tolist(), tids[order].tolist())]
+
+    def threads(self, query, board=None, since=None, until=None, limit=50):
+        # Threads with matching posts, most recently matching first, with their hit counts
+        _, times, tids = self._match(query, board, since, until)
+        if not len(tids):
+            return []
+        order = np.argsort(tids, kind='stable')
+        unique, starts, hits = np.unique(tids[order], return_index=True, return_counts=True)
+        first = np.minimum.reduceat(times[order], starts)
+        last = np.maximum.reduceat(times[order], starts)
+        top = np.argsort(-last, kind='stable')[:limit]
+        threads = self._threads_for(unique[top].tolist())
+        return [{'board': threads[tid][0], 'thread': threads[tid][1], 'hits': count, 'first': start, 'last': end} for tid, count, start, end in zip(unique[top].tolist(), hits[top].tolist(), first[top].tolist(), last[top].tolist())]
+
+    def flush(self):
+        if self._thread is not None:
+            self._queue.put(('flush', None, None, None))
+            self._queue.join()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(('stop', None, None, None))
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._db.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Search the full-text index of captured posts')
+    arg_parser.add_argument('query')
+    arg_parser.add_argument('--index', default='saves/text.sqlite')
+    arg_parser.add_argument('--board', default=None)
+    arg_parser.add_argument('--since', default=None, help='unix time or a duration ago such as 12h or 7d')
+    arg_parser.add_argument('--until', default=None)
+    arg_parser.add_argument('--limit', type=int, default=50)
+    arg_parser.add_argument('--posts', action='store_true', help='list matching posts instead of threads')
+    args = arg_parser.parse_args()
+    if not Path(args.index).exists():
+        sys.exit(f'No text index at {args.index}')
+    index = textindex(args.index)
+    started = time.monotonic()
+    if args.posts:
+        results = index.search(args.query, args.board, args.since, args.until, args.limit)
+        for result in results:
+            print(f"/{result['board']}/{result['thread']}#p{result['no']}\t{time.strftime('%Y-%m-%d %H:%M', time.gmtime(result['time']))}")
+    else:
+        results = index.threads(args.query, args.board, args.since, args.until, args.limit)
+        for result in results:
+            print(f"/{result['board']}/{result['thread']}\t{result['hits']} hits\tlast {time.strftime('%Y-%m-%d %H:%M', time.gmtime(result['last']))}")
+    print(f'{len(results)} results in {(time.monotonic() - started) * 1000:.1f} ms', file=sys.stderr)
+    index.close()
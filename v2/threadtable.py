@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class threadtable():
+    # One board's threads as int64 columns sorted by thread number, in place of a dict of
+    # str -> [last_modified, replies]; lookups by thread number accept str or int
+    def __init__(self, nos=(), last_modified=(), replies=(), pages=None):
+        nos = np.asarray(nos, dtype=np.int64)
+        order = np.argsort(nos, kind='stable')
+        self.nos = nos[order]
+        self.last_modified = np.asarray(last_modified, dtype=np.int64)[order]
+        self.replies = np.asarray(replies, dtype=np.int64)[order]
+        self.pages = np.zeros(len(nos), dtype=np.int16) if pages is None else np.asarray(pages, dtype=np.int16)[order]
+
+    @classmethod
+    def from_threadlist(cls, threads_json):
+        rows = [(thread['no'], thread['last_modified'], thread['replies'], page['page']) for page in threads_json for thread in page['threads']]
+        if not rows:
+            return cls()
+        return cls(*zip(*rows))
+
+    @classmethod
+    def from_dict(cls, threads):
+        return cls([int(no) for no in threads], [values[0] for values in threads.values()], [values[1] for values in threads.values()])
+
+    def to_dict(self):
+        return {str(no): [last_modified, replies] for no, last_modified, replies in zip(self.nos.tolist(), self.last_modified.tolist(), self.replies.tolist())}
+
+    def copy(self):
+        table = threadtable.__new__(threadtable)
+        table.nos = self.nos.copy()
+        table.last_modified = self.last_modified.copy()
+        table.replies = self.replies.copy()
+        table.pages = self.pages.copy()
+        return table
+
+    def _find(self, no):
+        no = int(no)
+        i = int(np.searchsorted(self.nos, no))
+        if i < len(self.nos) and self.nos[i] == no:
+            return i
+        return None
+
+    def __contains__(self, no):
+        return self._find(no) is not None
+
+    def __getitem__(self, no):
+        i = self._find(no)
+        if i is None:
+            raise KeyError(no)
+        return [int(self.last_modified[i]), int(self.replies[i])]
+
+    def get(self, no, default=None):
+        i = self._find(no)
+        return default if i is None else [int(self.last_modified[i]), int(self.replies[i])]
+
+    def page(self, no):
+        return int(self.pages[self._find(no)])
+
+    def __iter__(self):
+        return (str(no) for no in self.nos.tolist())
+
+    def __len__(self):
+        return len(self.nos)
+
+    @property
+    def page_count(self):
+        return int(self.pages.max()) if len(self.pages) else 0
+
+    def diff(self, current):
+        # Returns the thread numbers that died, were born and advanced their last_modified,
+        # plus the table to keep: current, but with our row wherever a thread did not advance
+        common, old_rows, new_rows = np.intersect1d(self.nos, current.nos, assume_unique=True, return_indices=True)
+        dead = np.setdiff1d(self.nos, common, assume_unique=True)
+        born = np.setdiff1d(current.nos, common, assume_unique=True)
+        advanced = self.last_modified[old_rows] < current.last_modified[new_rows]
+        merged = current.copy()
+        merged.last_modified[new_rows[~advanced]] = self.last_modified[old_rows[~advanced]]
+        merged.replies[new_rows[~advanced]] = self.replies[old_rows[~advanced]]
+        return dead, born, common[advanced], merged
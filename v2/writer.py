@@ -0,0 +1,118 @@
+import os
+import time
+import queue
+import threading
+
+
+class writebehind():
+    def __init__(self, threads=2, max_queued=1000, batch_size=32, fsync=True, logger=None):
+        self.threads = threads
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.blocked_puts = 0
+        self.blocked_seconds = 0.0
+        self.written = 0
+        # Called as job_timer(key, seconds) after each job when set
+        self.job_timer = None
+        self._logger = logger
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._queues = [queue.Queue(maxsize=max_queued) for _ in range(threads)]
+        self._workers = []
+        for i, jobs in enumerate(self._queues):
+            worker = threading.Thread(target=self._run, args=(jobs,), name=f'writer_{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def depth(self):
+        return sum(jobs.qsize() for jobs in self._queues)
+
+    def backpressure(self):
+        return {'depth': self.depth, 'blocked_puts': self.blocked_puts, 'blocked_seconds': self.blocked_seconds, 'written': self.written}
+
+    def is_pending(self, key):
+        return key in self._pending
+
+    def submit(self, key, func, *args):
+        # Jobs for one key always land on the same writer so they are applied in order
+        if not self._queues:
+            self._sync_paths(func(*args) or [])
+            self.written += 1
+            return
+        with self._pending_lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+        jobs = self._queues[hash(key) % len(self._queues)]
+        start = time.monotonic()
+        jobs.put((key, func, args))
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            self.blocked_puts += 1
+            self.blocked_seconds += waited
+
+    def _run(self, jobs):
+        running = True
+        while running:
+            batch = [jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(jobs.get_nowait())
+                except queue.Empty:
+                    break
+            touched = set()
+            for job in batch:
+                if job is None:
+                    running = False
+                    continue
+                key, func, args = job
+                start = time.perf_counter()
+                try:
+                    touched.update(func(*args) or [])
+                except Exception:
+                    if self._logger is not None:
+                        self._logger.exception(f'Write-behind job for {key} failed')
+                if self.job_timer is not None:
+                    self.job_timer(key, time.perf_counter() - start)
+                self.written += 1
+            self._sync_paths(touched)
+            with self._pending_lock:
+                for job in batch:
+                    if job is not None:
+                        self._pending[job[0]] -= 1
+                        if not self._pending[job[0]]:
+                            del self._pending[job[0]]
+            for _ in batch:
+                jobs.task_done()
+
+    def _sync_paths(self, paths):
+        if not self.fsync or not paths:
+            return
+        for path in paths:
+            try:
+                with open(path, 'rb') as synced:
+                    os.fsync(synced.fileno())
+            except OSError:
+                continue
+        for folder in {os.path.dirname(path) for path in paths}:
+            try:
+                fd = os.open(folder, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+    def flush(self):
+        for jobs in self._queues:
+            jobs.join()
+
+    def close(self):
+        for jobs in self._queues:
+            jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._queues = []
+        self._workers = []